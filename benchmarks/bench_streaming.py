@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Peak memory and time to first byte of a show response: the whole Sonarr document built as nested dicts and passed
+# to json.dumps, against skyhook.streaming.iter_show_json fed one episode at a time (as Show.iter_sonarr_json does
+# from yield_per rows). Episodes are synthetic daily talk show episodes with a full overview.
+#
+#   python benchmarks/bench_streaming.py [episodes ...]
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'skyhook'))
+from streaming import iter_show_json  # noqa: E402
+
+HEADER = {
+    'tvdbId': 71256, 'language': 'en', 'title': 'The Daily Show', 'overview': 'x' * 600, 'slug': 'the-daily-show',
+    'firstAired': '1996-07-22', 'tvRageId': 3010, 'tvMazeId': 249, 'status': 'Continuing', 'runtime': 30,
+    'timeOfDay': {'hours': 23}, 'network': 'Comedy Central', 'imdbId': 'tt0115147', 'actors': [], 'genres': ['Comedy'],
+    'contentRating': 'TV-14', 'rating': {'count': 1000, 'value': 8.1}
+}
+
+
+def seasons(count):
+    for number in range(1, count // 160 + 2):
+        yield {'seasonNumber': number, 'images': []}
+
+
+def episodes(count):
+    # One dict at a time, like the episode rows of Show.iter_sonarr_json
+    for number in range(count):
+        yield {
+            'tvdbShowId': 71256, 'tvdbId': 1000000 + number, 'seasonNumber': number // 160 + 1,
+            'episodeNumber': number % 160 + 1, 'absoluteEpisodeNumber': number + 1, 'title': 'Episode %d' % number,
+            'airDate': '2016-01-01', 'airDateUtc': '2016-01-02T04:00:00Z', 'rating': {'count': 3, 'value': 7.5},
+            'overview': 'Guest %d talks about things. ' % number * 8, 'image': 'episodes/71256/%d.jpg' % number
+        }
+
+
+def whole_document(count):
+    document = dict(HEADER)
+    document['seasons'] = list(seasons(count))
+    document['episodes'] = list(episodes(count))
+    yield json.dumps(document)
+
+
+def streamed_document(count):
+    return iter_show_json(HEADER, seasons(count), episodes(count))
+
+
+def measure(respond, count):
+    # Returns (time to first chunk, total time, peak bytes allocated, response bytes)
+    tracemalloc.start()
+    started = time.perf_counter()
+    chunks = respond(count)
+    first = None
+    size = 0
+    for chunk in chunks:
+        if first is None:
+            first = time.perf_counter() - started
+        size += len(chunk.encode('utf-8'))
+    total = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return first, total, peak, size
+
+
+def main():
+    counts = [int(count) for count in sys.argv[1:]] or [500, 5000, 20000]
+    print('%8s  %-9s %10s %10s %12s %12s' % ('episodes', 'mode', 'ttfb ms', 'total ms', 'peak KiB', 'body KiB'))
+    for count in counts:
+        whole = ''.join(whole_document(count))
+        if json.loads(whole) != json.loads(''.join(streamed_document(count))):
+            sys.exit('Streamed document differs from the json.dumps document')
+        for mode, respond in (('dumps', whole_document), ('streamed', streamed_document)):
+            first, total, peak, size = measure(respond, count)
+            print('%8d  %-9s %10.2f %10.2f %12.0f %12.0f' % (count, mode, first * 1000, total * 1000, peak / 1024.0,
+                                                             size / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
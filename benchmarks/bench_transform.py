@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Microbenchmark of the airDateUtc computation in TvDB.to_sonarr_format: the per-episode loop it used to run
+# against skyhook.transform.EpisodeTransformer. Importing the skyhook package starts the app and connects to
+# the database, so the transform module is loaded on its own.
+#
+#   python benchmarks/bench_transform.py [episodes] [repeat]
+import datetime
+import os
+import random
+import sys
+import timeit
+
+import dateutil.parser
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'skyhook'))
+from transform import EpisodeTransformer, parse_air_time  # noqa: E402
+
+TIMEZONES = {'en': 'EST', 'no': 'Europe/Oslo', 'da': 'Europe/Copenhagen', 'sv': 'Europe/Stockholm'}
+
+
+def make_episodes(count):
+    random.seed(count)
+    start = datetime.date(1990, 1, 1)
+    episodes = []
+    for number in range(count):
+        aired = start + datetime.timedelta(days=number * 3)
+        episodes.append({
+            'firstaired': aired.strftime('%Y-%m-%d') if number % 50 else None,
+            'language': random.choice(list(TIMEZONES))
+        })
+    return episodes
+
+
+def old_loop(episodes, airs_time):
+    # The loop from TvDB.to_sonarr_format before EpisodeTransformer
+    hours = dateutil.parser.parse(airs_time).hour if airs_time is not None else None
+    minutes = dateutil.parser.parse(airs_time).minute if airs_time is not None else None
+    results = []
+    for episode in episodes:
+        air_date_utc = None
+        if episode['firstaired'] is not None and hours is not None:
+            timezone = pytz.timezone(TIMEZONES.get(episode['language'], 'EST'))
+            date = dateutil.parser.parse(episode['firstaired']) + datetime.timedelta(hours=hours, minutes=minutes)
+            date = timezone.localize(date)
+            date = date.astimezone(pytz.timezone('UTC'))
+            air_date_utc = date.strftime("%Y-%m-%dT%H:%M:%SZ")
+        results.append(air_date_utc)
+    return results
+
+
+def new_pass(episodes, airs_time, transformer):
+    sonarr_episodes = [{'airDate': episode['firstaired'], 'airDateUtc': None} for episode in episodes]
+    languages = [episode['language'] for episode in episodes]
+    transformer.set_air_dates_utc(sonarr_episodes, languages, parse_air_time(airs_time))
+    return [episode['airDateUtc'] for episode in sonarr_episodes]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    episodes = make_episodes(count)
+    airs_time = '9:30 PM'
+    transformer = EpisodeTransformer(TIMEZONES, 'EST')
+
+    if old_loop(episodes, airs_time) != new_pass(episodes, airs_time, transformer):
+        sys.exit('EpisodeTransformer output differs from the old loop')
+
+    old = min(timeit.repeat(lambda: old_loop(episodes, airs_time), number=1, repeat=repeat))
+    new = min(timeit.repeat(lambda: new_pass(episodes, airs_time, transformer), number=1, repeat=repeat))
+    print('%d episodes, best of %d' % (count, repeat))
+    print('  old loop:           %8.2f ms' % (old * 1000))
+    print('  EpisodeTransformer: %8.2f ms' % (new * 1000))
+    print('  speedup:            %8.1fx' % (old / new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+import math
+
+
+def percentile(values, fraction):
+    # Nearest rank: the smallest value with at least fraction of all values at or below it
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[max(0, int(math.ceil(fraction * len(ordered))) - 1)]
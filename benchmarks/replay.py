@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+# Replays production traffic from the uwsgi request log (req-logger in skyhook.ini) against a running Skyhook, to
+# judge caching and concurrency changes with the real request mix.
+#
+#   python benchmarks/replay.py parse /tmp/skyhook_uwsgi.log -o workload.json
+#   python benchmarks/replay.py replay workload.json http://localhost:5000 [--speed 2] [--concurrency 32] -o run.json
+#   python benchmarks/replay.py compare before.json after.json
+#
+# parse keeps the search and show requests of the log (--all keeps every request) with their offset from the first
+# one. uwsgi logs request times to the second, requests logged in the same second are spread evenly over it.
+# replay sends every request at its original offset divided by --speed (--speed 0 sends them as fast as the workers
+# allow) from --concurrency workers, and reports latency percentiles and a histogram per kind of request. The cache
+# hit rates and upstream request counts come from the /metrics numbers before and after the run, they cover the
+# worker that answered /metrics, so replay against a single uwsgi process when they matter. replay also accepts a
+# log file in place of a workload. uwsgi doesn't log request bodies, requests other than GET and HEAD (POSTed batches)
+# would be sent empty, replay skips them and reports how many it skipped.
+import argparse
+import datetime
+import json
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+from latency import percentile
+
+LOG_LINE = re.compile(r'\[pid: \d+\|app: -?\d+\|req: [\d-]+/\d+\] \S* \(.*?\) \{.*?\} \[(?P<time>[^\]]+)\] '
+                      r'(?P<method>[A-Z]+) (?P<uri>\S+) => generated (?P<bytes>\d+) bytes in (?P<msecs>\d+) msecs '
+                      r'\(\S+ (?P<status>\d{3})\)')
+LOG_TIME = '%a %b %d %H:%M:%S %Y'
+SEARCH = re.compile(r'^/v1/tvdb/search/[^/]*/?$')
+SHOW = re.compile(r'^/v1/tvdb/shows/[^/]+/(?P<tvdb_id>[^/?]+)$')
+# Upper bounds in milliseconds
+HISTOGRAM = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+METRIC_LINE = re.compile(r'^(?P<name>[a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(?P<labels>.*)\})? (?P<value>\S+)$')
+METRIC_LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+# Methods whose requests are complete without a body
+REPLAYABLE_METHODS = ('GET', 'HEAD')
+
+
+def classify(uri):
+    # (kind, search term or tvdb id)
+    parts = urlsplit(uri)
+    if SEARCH.match(parts.path):
+        return 'search', parse_qs(parts.query).get('term', [''])[0]
+    match = SHOW.match(parts.path)
+    if match is not None:
+        if match.group('tvdb_id') == 'batch':
+            return 'batch', None
+        return 'shows', match.group('tvdb_id')
+    return 'other', None
+
+
+def parse_log(lines, keep_all=False):
+    entries = []
+    for line in lines:
+        match = LOG_LINE.search(line)
+        if match is None:
+            continue
+        kind, key = classify(match.group('uri'))
+        if kind == 'other' and not keep_all:
+            continue
+        entries.append({
+            'time': datetime.datetime.strptime(match.group('time'), LOG_TIME),
+            'method': match.group('method'),
+            'uri': match.group('uri'),
+            'kind': kind,
+            'key': key,
+            'status': int(match.group('status')),
+            'msecs': int(match.group('msecs'))
+        })
+    if not entries:
+        return []
+    first = entries[0]['time']
+    per_second = {}
+    for entry in entries:
+        per_second.setdefault(entry['time'], []).append(entry)
+    for second, logged in per_second.items():
+        for index, entry in enumerate(logged):
+            entry['offset'] = (second - first).total_seconds() + index / float(len(logged))
+    for entry in entries:
+        del entry['time']
+    return sorted(entries, key=lambda entry: entry['offset'])
+
+
+def load_workload(path):
+    with open(path) as f:
+        if path.endswith('.json'):
+            return json.load(f)['requests']
+        return parse_log(f)
+
+
+def scrape_metrics(target):
+    # {(name, ((label, value), ...)): value} of the /metrics endpoint, None when it can't be read
+    try:
+        response = requests.get(target + '/metrics', timeout=10)
+        response.raise_for_status()
+    except requests.RequestException:
+        return None
+    samples = {}
+    for line in response.text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match is None:
+            continue
+        labels = tuple(sorted(METRIC_LABEL.findall(match.group('labels') or '')))
+        samples[(match.group('name'), labels)] = float(match.group('value'))
+    return samples
+
+
+def cache_stats(before, after):
+    # Lookups by cache and result made during the run, the hit rate of every cache and the upstream requests sent
+    if before is None or after is None:
+        return None
+    lookups = {}
+
+    def add(cache, result, count):
+        if count:
+            lookups.setdefault(cache, {})
+            lookups[cache][result] = lookups[cache].get(result, 0) + count
+
+    upstream = 0
+    for (name, labels), value in after.items():
+        count = value - before.get((name, labels), 0)
+        labels = dict(labels)
+        if name == 'skyhook_cache_lookups_total':
+            add(labels['cache'], labels['result'], count)
+        elif name == 'skyhook_memory_cache_hits_total':
+            add(labels['cache'] + '_memory', 'hit', count)
+        elif name == 'skyhook_memory_cache_misses_total':
+            add(labels['cache'] + '_memory', 'miss', count)
+        elif name == 'skyhook_upstream_request_duration_seconds_count':
+            upstream += count
+    hit_rates = dict((cache, results.get('hit', 0) / float(sum(results.values())))
+                     for cache, results in lookups.items())
+    return {'lookups': lookups, 'hit_rates': hit_rates, 'upstream_requests': upstream}
+
+
+class Replay(object):
+    # Sends the workload at its original pace (scaled by speed) from a pool of workers. Lag is how late a request was
+    # sent compared to its schedule, it grows when the workers can't keep up.
+    def __init__(self, target, speed, concurrency, timeout):
+        self.target = target.rstrip('/')
+        self.speed = speed
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def session(self):
+        if getattr(self.local, 'session', None) is None:
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def send(self, entry, scheduled):
+        sent = time.perf_counter()
+        try:
+            response = self.session().request(entry['method'], self.target + entry['uri'], timeout=self.timeout)
+            status = response.status_code
+            size = len(response.content)
+        except requests.RequestException:
+            status = None
+            size = 0
+        return {'kind': entry['kind'], 'uri': entry['uri'], 'status': status, 'bytes': size,
+                'latency': time.perf_counter() - sent, 'lag': sent - scheduled}
+
+    def run(self, workload):
+        futures = []
+        started = time.perf_counter()
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            for entry in workload:
+                scheduled = started + (entry['offset'] / self.speed if self.speed > 0 else 0)
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                futures.append(executor.submit(self.send, entry, max(scheduled, started)))
+            results = [future.result() for future in futures]
+        return results, time.perf_counter() - started
+
+
+def summarize(results, duration):
+    # Latency distribution per kind of request and for all of them
+    kinds = {}
+    for result in results:
+        kinds.setdefault(result['kind'], []).append(result)
+    kinds['all'] = results
+    summary = {}
+    for kind, kind_results in kinds.items():
+        latencies = [result['latency'] * 1000 for result in kind_results if result['status'] is not None]
+        histogram = [0] * (len(HISTOGRAM) + 1)
+        for latency in latencies:
+            histogram[next((index for index, bound in enumerate(HISTOGRAM) if latency <= bound), len(HISTOGRAM))] += 1
+        summary[kind] = {
+            'requests': len(kind_results),
+            'errors': sum(1 for result in kind_results if result['status'] is None or result['status'] >= 500),
+            'not_modified': sum(1 for result in kind_results if result['status'] == 304),
+            'throughput': len(kind_results) / duration if duration else float('nan'),
+            'mean': sum(latencies) / len(latencies) if latencies else float('nan'),
+            'p50': percentile(latencies, 0.5),
+            'p90': percentile(latencies, 0.9),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies) if latencies else float('nan'),
+            'lag_p99': percentile([result['lag'] * 1000 for result in kind_results], 0.99),
+            'histogram': histogram
+        }
+    return summary
+
+
+def print_summary(run):
+    print('%-7s %7s %6s %8s %9s %9s %9s %9s %9s %9s' % ('kind', 'reqs', 'errors', 'req/s', 'mean ms', 'p50 ms',
+                                                        'p90 ms', 'p99 ms', 'max ms', 'lag p99'))
+    for kind, stats in sorted(run['summary'].items()):
+        print('%-7s %7d %6d %8.1f %9.1f %9.1f %9.1f %9.1f %9.1f %9.1f' % (
+            kind, stats['requests'], stats['errors'], stats['throughput'], stats['mean'], stats['p50'], stats['p90'],
+            stats['p99'], stats['max'], stats['lag_p99']))
+    print()
+    labels = ['<=' + str(bound) for bound in HISTOGRAM] + ['>' + str(HISTOGRAM[-1])]
+    print('%-7s ' % 'ms' + ' '.join('%7s' % label for label in labels))
+    for kind, stats in sorted(run['summary'].items()):
+        print('%-7s ' % kind + ' '.join('%7d' % count for count in stats['histogram']))
+    cache = run.get('cache')
+    print()
+    if cache is None:
+        print('No cache numbers, ' + run['target'] + '/metrics could not be read')
+        return
+    for name, rate in sorted(cache['hit_rates'].items()):
+        print('%-14s hit rate %6.1f%%  %s' % (name, rate * 100, ', '.join(
+            result + '=' + str(int(count)) for result, count in sorted(cache['lookups'][name].items()))))
+    print('upstream requests: ' + str(int(cache['upstream_requests'])))
+
+
+def compare(before, after):
+    # Side by side, with the change from before to after
+    print('%-7s %-10s %12s %12s %9s' % ('kind', 'stat', before['name'], after['name'], 'change'))
+    for kind in sorted(set(before['summary']) & set(after['summary'])):
+        for stat in ('requests', 'errors', 'throughput', 'mean', 'p50', 'p90', 'p99', 'max'):
+            old = before['summary'][kind][stat]
+            new = after['summary'][kind][stat]
+            change = (new - old) / float(old) * 100 if old else float('nan')
+            print('%-7s %-10s %12.1f %12.1f %8.1f%%' % (kind, stat, old, new, change))
+    if before.get('cache') and after.get('cache'):
+        for name in sorted(set(before['cache']['hit_rates']) | set(after['cache']['hit_rates'])):
+            old = before['cache']['hit_rates'].get(name, float('nan')) * 100
+            new = after['cache']['hit_rates'].get(name, float('nan')) * 100
+            print('%-7s %-10s %11.1f%% %11.1f%% %8.1f pt' % ('cache', name[:10], old, new, new - old))
+        print('%-7s %-10s %12d %12d' % ('cache', 'upstream', before['cache']['upstream_requests'],
+                                        after['cache']['upstream_requests']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay uwsgi request logs against Skyhook')
+    commands = parser.add_subparsers(dest='command')
+    parse = commands.add_parser('parse', help='turn a uwsgi request log into a workload')
+    parse.add_argument('log')
+    parse.add_argument('-o', '--output', required=True)
+    parse.add_argument('--all', action='store_true', help='keep requests other than searches and shows')
+    replay = commands.add_parser('replay', help='replay a workload (or log) against a Skyhook instance')
+    replay.add_argument('workload')
+    replay.add_argument('target', help='base URL, e.g. http://localhost:5000')
+    replay.add_argument('--speed', type=float, default=1.0, help='speed up factor, 0 sends as fast as possible')
+    replay.add_argument('--concurrency', type=int, default=16)
+    replay.add_argument('--timeout', type=float, default=60)
+    replay.add_argument('--limit', type=int, help='replay only the first requests')
+    replay.add_argument('--only', action='append', choices=['search', 'shows', 'batch', 'other'])
+    replay.add_argument('--name', help='name of the run in comparisons, the output file name by default')
+    replay.add_argument('-o', '--output', help='write the run to this file, for compare')
+    compare_runs = commands.add_parser('compare', help='compare two replay runs')
+    compare_runs.add_argument('before')
+    compare_runs.add_argument('after')
+    args = parser.parse_args()
+
+    if args.command == 'parse':
+        with open(args.log) as f:
+            workload = parse_log(f, args.all)
+        with open(args.output, 'w') as f:
+            json.dump({'source': args.log, 'requests': workload}, f)
+        kinds = {}
+        for entry in workload:
+            kinds[entry['kind']] = kinds.get(entry['kind'], 0) + 1
+        print(str(len(workload)) + ' requests over ' + ('%.0f' % workload[-1]['offset'] if workload else '0') +
+              ' seconds: ' + ', '.join(kind + '=' + str(count) for kind, count in sorted(kinds.items())))
+    elif args.command == 'replay':
+        workload = load_workload(args.workload)
+        skipped = sum(1 for entry in workload if entry['method'] not in REPLAYABLE_METHODS)
+        workload = [entry for entry in workload if entry['method'] in REPLAYABLE_METHODS]
+        if skipped:
+            print('Skipped ' + str(skipped) + ' requests that were logged without their body')
+        if args.only:
+            workload = [entry for entry in workload if entry['kind'] in args.only]
+        if args.limit:
+            workload = workload[:args.limit]
+        if workload:
+            # A filtered workload starts right away
+            first = workload[0]['offset']
+            workload = [dict(entry, offset=entry['offset'] - first) for entry in workload]
+        target = args.target.rstrip('/')
+        before = scrape_metrics(target)
+        results, duration = Replay(target, args.speed, args.concurrency, args.timeout).run(workload)
+        run = {
+            'name': args.name or (args.output or 'run'),
+            'target': target,
+            'workload': args.workload,
+            'speed': args.speed,
+            'concurrency': args.concurrency,
+            'duration': duration,
+            'skipped': skipped,
+            'summary': summarize(results, duration),
+            'cache': cache_stats(before, scrape_metrics(target)),
+            'results': results
+        }
+        print_summary(run)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(run, f)
+    elif args.command == 'compare':
+        with open(args.before) as f:
+            before = json.load(f)
+        with open(args.after) as f:
+            after = json.load(f)
+        compare(before, after)
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -29,15 +29,17 @@ setup(
     keywords='skyhook sonarr tracker torrents tvdb tvmaze',
     packages=find_packages(),
     install_requires=[
+        'aiohttp>=3.3,<4',
         'Flask==0.10.1',
         'Flask-SQLAlchemy==2.1',
         'lxml==3.6.0',
         'psycopg2==2.6.1',
         'python-dateutil==2.5.3',
-        'pytvmaze==1.5.1',
         'pytz==2016.4',
         'requests==2.10.0',
+        'requests-cache',
         'slackweb==1.0.5',
+        'SQLAlchemy>=1.1',
         'tvdb-api==1.10'
     ],
     extras_require={
@@ -1,4 +1,5 @@
 import os
+import tempfile
 basedir = os.path.abspath(os.path.dirname(__file__))
 
 class Config(object):
@@ -8,16 +9,105 @@ class Config(object):
     # DATABASE
     SEARCH_CACHE_TIME = 86400
     SHOW_CACHE_TIME = 86400
+    # Shows past SHOW_CACHE_TIME are served stale while they refresh in the background,
+    # past SHOW_HARD_EXPIRY_TIME the request waits for the refresh instead
+    SHOW_HARD_EXPIRY_TIME = 604800
+    REFRESH_WORKERS = 2
+    # Refresh shows ahead of their next episode (PREWARM_LEAD_TIME seconds before it airs) and stale continuing shows,
+    # ended shows only every PREWARM_ENDED_INTERVAL. At most PREWARM_BUDGET refreshes every PREWARM_INTERVAL seconds.
+    PREWARM_ENABLED = True
+    PREWARM_INTERVAL = 300
+    PREWARM_BUDGET = 20
+    PREWARM_LEAD_TIME = 21600
+    PREWARM_ENDED_INTERVAL = 2592000
     DB_HOST = 'localhost'
     DB_USERNAME = 'skyhook'
     DB_PASSWORD = 'skyhook'
     DB_NAME = 'skyhook'
     DB_PORT = 5432
 
+    # MEMORY CACHE
+    # In-process cache in front of the database, entries still expire after SEARCH_CACHE_TIME / SHOW_CACHE_TIME.
+    MEMORY_CACHE_SEARCHES = 10000
+    MEMORY_CACHE_SHOW_BYTES = 256 * 1024 * 1024
+
+    # STREAMING
+    # Shows with more episodes than this are not kept as a serialized document but encoded from the database on every
+    # request, STREAM_EPISODE_BATCH episode rows at a time
+    STREAM_SHOW_EPISODES = 2000
+    STREAM_EPISODE_BATCH = 500
+
+    # DELTAS
+    # ?since= answers with what changed after a revision. Deleted seasons and episodes are kept for the last
+    # DELTA_KEEP_REVISIONS revisions of a show, clients further behind get the whole show.
+    DELTA_KEEP_REVISIONS = 100
+
+    # BATCH
+    # Most shows one batch request may ask for, shows that have to be fetched are fetched BATCH_FETCH_WORKERS at a time
+    BATCH_MAX_SHOWS = 1000
+    BATCH_FETCH_WORKERS = 4
+
+    # COMPRESSION
+    # Responses of at least GZIP_MIN_BYTES are gzipped for clients that accept it
+    GZIP_ENABLED = True
+    GZIP_MIN_BYTES = 1024
+    GZIP_LEVEL = 6
+
+    # SEARCH INDEX
+    # Searches are answered from the titles of cached shows when a match scores at least SEARCH_INDEX_MIN_SCORE
+    # (1 is an exact title), searches that find nothing upstream fall back to matches above SEARCH_INDEX_FUZZY_SCORE.
+    # A lone partial word scores at most 0.75, keep SEARCH_INDEX_MIN_SCORE above that so it still reaches TVDB.
+    # Shows cached by other workers are picked up every SEARCH_INDEX_SYNC_INTERVAL seconds.
+    SEARCH_INDEX_ENABLED = True
+    SEARCH_INDEX_MIN_SCORE = 0.85
+    SEARCH_INDEX_FUZZY_SCORE = 0.5
+    SEARCH_INDEX_LIMIT = 10
+    SEARCH_INDEX_SYNC_INTERVAL = 60
+
+    # PROFILING
+    # Requests with the PROFILE_HEADER header or the PROFILE_FLAG query argument set to PROFILE_TOKEN, and
+    # PROFILE_SAMPLE_RATE of all other requests, are sampled every PROFILE_INTERVAL seconds. A collapsed stack file
+    # and a JSON file with the SQL statements are written to PROFILE_DIR for each of them. Without a PROFILE_TOKEN
+    # the header and the query argument are ignored, anyone could fill PROFILE_DIR with them.
+    PROFILE_ENABLED = False
+    PROFILE_HEADER = 'X-Skyhook-Profile'
+    PROFILE_FLAG = 'profile'
+    PROFILE_TOKEN = None
+    PROFILE_SAMPLE_RATE = 0.0
+    PROFILE_INTERVAL = 0.005
+    # Sample every thread instead of the request thread alone, upstream downloads and parsing run on other threads
+    PROFILE_ALL_THREADS = False
+    PROFILE_DIR = os.path.join(tempfile.gettempdir(), 'skyhook_profiles')
+
     # TVDB
     # Get TVDB API Key here: http://thetvdb.com/?tab=apiregister
     TVDB_API_KEY = ''
     TVDB_LANGUAGES = ['no', 'da', 'en']
+    # Seconds to wait for the per-language searches, languages that haven't answered by then are skipped
+    TVDB_SEARCH_TIMEOUT = 10
+    # Seconds allowed to find a title for a TVDB ID, and per request when scraping the TVDB series page
+    TVDB_RESOLVE_TIMEOUT = 10
+    TVDB_SCRAPE_TIMEOUT = 5
+
+    # UPSTREAM
+    # Worker threads shared by all concurrent upstream requests
+    UPSTREAM_WORKERS = 16
+    # Pooled keep-alive connections: number of hosts kept and connections per host
+    UPSTREAM_POOL_HOSTS = 10
+    UPSTREAM_POOL_SIZE = 16
+    UPSTREAM_CONNECT_TIMEOUT = 3.05
+    UPSTREAM_READ_TIMEOUT = 15
+    # Retries on connection errors and 5xx responses, with jittered exponential backoff
+    UPSTREAM_RETRIES = 2
+    UPSTREAM_RETRY_BACKOFF = 0.5
+    # Seconds a worker waits for another process fetching the same show or search, after that it fetches as well
+    UPSTREAM_LOCK_TIMEOUT = 10
+    # Connection limits of the asyncio client that downloads TVDB series data and TV Maze lookups
+    AIO_CONNECTIONS = 200
+    AIO_CONNECTIONS_PER_HOST = 50
+    # Base URLs of servers standing in for upstream hosts, e.g. {'thetvdb.com': 'http://localhost:8081'} to run
+    # against the emulated upstreams of benchmarks/bench_upstream.py
+    UPSTREAM_HOSTS = {}
 
     # SLACK
     SLACK_WEBHOOK = None
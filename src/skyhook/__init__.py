@@ -4,12 +4,22 @@ from instance.config import DebugConfig
 
 app = Flask(__name__)
 app.config.from_object(DebugConfig)
+# Settings file overriding the config, e.g. for benchmarks
+app.config.from_envvar('SKYHOOK_SETTINGS', silent=True)
 db = SQLAlchemy(app)
 
+from skyhook.upstream import Upstream
+upstream = Upstream(app.config)
+
+from skyhook.aio import AsyncUpstream
+aio = AsyncUpstream(app.config)
+
 from skyhook.tvdb import TvDB
-tvdb = TvDB(app.config['TVDB_API_KEY'])
+tvdb = TvDB(app.config['TVDB_API_KEY'], upstream, aio)
 
 print('Starting Sonarr Skyhook v' + app.config['VERSION'])
 import skyhook.models
 db.create_all()
+from skyhook.migrations import migrate
+migrate()
 import skyhook.views
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import random
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import aiohttp
+import tvdb_api
+from skyhook.metrics import upstream_errors, upstream_latency
+from skyhook.upstream import RETRY_STATUSES, TVMazeShow, redirect_url
+
+
+class PreloadedTvdb(tvdb_api.Tvdb):
+    # tvdb_api client that parses responses which were already downloaded, so the parsing (and the show objects
+    # TvDB.to_sonarr_format reads) stays exactly the same while the downloads happen concurrently elsewhere.
+    def __init__(self, responses, **kwargs):
+        self.responses = responses
+        super(PreloadedTvdb, self).__init__(cache=False, **kwargs)
+
+    def _loadUrl(self, url, recache=False, language=None):
+        if url in self.responses and not recache:
+            return self.responses[url]
+        return super(PreloadedTvdb, self)._loadUrl(url, recache, language)
+
+
+class AsyncUpstream(object):
+    # Event loop on its own thread with one shared aiohttp session, so any number of upstream requests can be in
+    # flight at once. Blocking code submits coroutines to it with run().
+    def __init__(self, config):
+        self.config = config
+        self.loop = None
+        self.session = None
+        self.thread = None
+        self.lock = threading.Lock()
+        # Requests sent per pool, keyed like the pools of pool_stats
+        self.requests = {}
+
+    def start(self):
+        # Started lazily so the loop thread is created in the worker process, not in the uwsgi master
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(target=self.loop.run_forever, name='skyhook-aio')
+            self.thread.daemon = True
+            self.thread.start()
+            self.session = asyncio.run_coroutine_threadsafe(self.create_session(), self.loop).result()
+
+    async def create_session(self):
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.config['AIO_CONNECTIONS'],
+                limit_per_host=self.config['AIO_CONNECTIONS_PER_HOST']
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=self.config['UPSTREAM_READ_TIMEOUT'],
+                connect=self.config['UPSTREAM_CONNECT_TIMEOUT']
+            )
+        )
+
+    def run(self, coroutine):
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def get(self, url, params=None, missing_ok=False):
+        # Connection errors and 5xx responses are retried with the jittered backoff of the requests transport, any
+        # other error response raises so error pages never reach the XML parser. A 404 is returned with an empty body
+        # when missing_ok is set.
+        retries = self.config['UPSTREAM_RETRIES']
+        target = redirect_url(url, self.config['UPSTREAM_HOSTS'])
+        pool = pool_name(target)
+        with measured(url):
+            for attempt in range(retries + 1):
+                if attempt:
+                    await asyncio.sleep(random.uniform(0, self.config['UPSTREAM_RETRY_BACKOFF'] * 2 ** (attempt - 1)))
+                self.requests[pool] = self.requests.get(pool, 0) + 1
+                try:
+                    async with self.session.get(target, params=params) as response:
+                        if missing_ok and response.status == 404:
+                            return response.status, b''
+                        response.raise_for_status()
+                        return response.status, await response.read()
+                except aiohttp.ClientResponseError as e:
+                    if e.status not in RETRY_STATUSES or attempt == retries:
+                        raise
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                    if attempt == retries:
+                        raise
+
+    async def get_many(self, urls):
+        # Downloads every url at once, returns {url: body}
+        bodies = await asyncio.gather(*[self.get(url) for url in urls])
+        return dict((url, body) for url, (status, body) in zip(urls, bodies))
+
+    async def get_tvmaze_show(self, tvdb_id):
+        status, body = await self.get('http://api.tvmaze.com/lookup/shows', params={'thetvdb': str(tvdb_id)},
+                                      missing_ok=True)
+        if status == 404:
+            return None
+        show = json.loads(body.decode('utf-8'))
+        return TVMazeShow(show['id'], show['name'], show['externals'] or {})
+
+    def pool_stats(self):
+        # Like Upstream.pool_stats, connections being the ones open now. Read on the loop thread, which is the only
+        # one changing the connector.
+        if self.session is None:
+            return {}
+        return self.run(self.collect_pool_stats())
+
+    async def collect_pool_stats(self):
+        # aiohttp has no public accessors for its connection pools, these are the connector's own books
+        connector = self.session.connector
+        stats = {}
+        for key in set(connector._conns) | set(connector._acquired_per_host):
+            idle = len(connector._conns.get(key, ()))
+            pool = ('https' if key.is_ssl else 'http') + '://' + key.host + ':' + str(key.port)
+            stats[pool] = {
+                'connections': idle + len(connector._acquired_per_host.get(key, ())),
+                'requests': self.requests.get(pool, 0),
+                'idle': idle,
+                'maxsize': connector.limit_per_host
+            }
+        for pool, requests in self.requests.items():
+            if pool not in stats:
+                stats[pool] = {'connections': 0, 'requests': requests, 'idle': 0, 'maxsize': connector.limit_per_host}
+        return stats
+
+
+def pool_name(url):
+    parts = urlsplit(url)
+    return parts.scheme + '://' + parts.hostname + ':' + str(parts.port or (443 if parts.scheme == 'https' else 80))
+
+
+@contextmanager
+def measured(url):
+    # Records one upstream request made inside the block, retries included, the way MetricsMixin records one made with
+    # requests: latency when a response came back, an error for a 5xx response or no response at all
+    host = urlsplit(url).hostname
+    started = time.time()
+    try:
+        yield
+    except aiohttp.ClientResponseError as e:
+        upstream_latency.observe(time.time() - started, host=host, client='aiohttp')
+        if e.status >= 500:
+            upstream_errors.inc(host=host, client='aiohttp')
+        raise
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        upstream_errors.inc(host=host, client='aiohttp')
+        raise
+    upstream_latency.observe(time.time() - started, host=host, client='aiohttp')
@@ -1,14 +1,61 @@
 import datetime
 import pytz
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from flask import g, has_request_context
 from skyhook import app, tvdb, db
+from skyhook.coalesce import SingleFlight, advisory_lock
+from skyhook.diff import ChangeCounter, RowDiff, combined_hash
+from skyhook.encoding import gzip_bytes, strong_etag
 from skyhook.exceptions import CacheShowLanguage
 from skyhook.logger import Logger
+from skyhook.lru import TTLCache
+from skyhook.metrics import cache_lookups, stage_latency
+from sqlalchemy import case
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm.exc import NoResultFound
 
-from skyhook.models import Show, Search, Season, Episode
+from skyhook.models import Show, Search, Season, Episode, SeriesTitle, ShowDocument, Deletion
+from skyhook.numbering import assign_absolute_numbers
+from skyhook.prewarm import Prewarmer
+from skyhook.refresh import Refresher
+from skyhook.search_index import SearchIndex
 
 logging = Logger(__name__)
 
+CachedSearch = namedtuple('CachedSearch', ['search_string', 'language', 'date', 'results'])
+
+
+def record_lookup(cache, result):
+    cache_lookups.inc(cache=cache, result=result)
+    tag_lookup(cache, result)
+
+
+def tag_lookup(cache, result):
+    # Lookups made for the current request, profiles are tagged with them
+    if has_request_context() and g.get('lookups') is not None:
+        g.lookups.append(cache + '=' + result)
+
+
+class CachedDocument(object):
+    # A serialized show document with its validators, changed is when its content last changed (UTC). The gzipped
+    # form is made on first use and kept with it.
+    __slots__ = ('document', 'etag', 'changed', 'gzipped')
+
+    def __init__(self, document, etag, changed):
+        self.document = document
+        self.etag = etag
+        self.changed = changed
+        self.gzipped = None
+
+    def __len__(self):
+        return len(self.document)
+
+    def get_gzipped(self, level):
+        if self.gzipped is None:
+            self.gzipped = gzip_bytes(self.document, level)
+        return self.gzipped
+
 
 def handle_search(search_string, results, with_episodes=True):
     sonarr_results = []
@@ -16,8 +63,8 @@ def handle_search(search_string, results, with_episodes=True):
     if results is None:
         SonarrCache.update_search(search_string, 'en', search_results)
         return sonarr_results
-    for result in results:
-        sonarr_format = tvdb.to_sonarr_format(result)
+    SeriesTitle.remember([(result['id'], result['language'], result['seriesname']) for result in results])
+    for result, sonarr_format in zip(results, tvdb.to_sonarr_formats(results)):
         if result['language'] not in search_results:
             search_results[result['language']] = []
         search_results[result['language']].append(result['id'])
@@ -35,31 +82,26 @@ def handle_search(search_string, results, with_episodes=True):
 
 class SonarrCache:
     cache_time = 86400
-
-    @classmethod
-    def has_season(cls, show_title, season):
-        try:
-            db.session.query(Season).filter_by(show_title=show_title, number=season).one()
-            return True
-        except NoResultFound:
-            return False
-
-    @classmethod
-    def has_episode(cls, season_id, episode):
-        try:
-            db.session.query(Episode).filter_by(season_id=season_id, number=episode).one()
-            return True
-        except NoResultFound:
-            return False
+    # In-process tier in front of Postgres. Searches are kept as CachedSearch snapshots, shows as their serialized
+    # documents (weighed in bytes), since ORM instances can't outlive the session that loaded them.
+    search_memory = TTLCache(app.config['MEMORY_CACHE_SEARCHES'], app.config['SEARCH_CACHE_TIME'])
+    show_memory = TTLCache(app.config['MEMORY_CACHE_SHOW_BYTES'], app.config['SHOW_CACHE_TIME'], weigh=len)
+    # Upstream fetches in flight, keyed by (normalized search string, language) and ('show', tvdb_id, language)
+    search_flights = SingleFlight()
+    show_flights = SingleFlight()
+    # Rows written by update_show since start, per table
+    row_changes = ChangeCounter()
+    # Titles of every cached show, keyed by (tvdb_id, language)
+    search_index = SearchIndex()
 
     @classmethod
     def update_search(cls, search_string, language, results):
         search_string = search_string.lower()
         logging.debug('Attempting to update Sonarr search cache for search string "' + str(search_string) + '"')
-        if cls.has_cached_results(search_string=search_string, language=language, check_date=False):
+        instance = db.session.query(Search).filter_by(search_string=search_string, language=language).first()
+        if instance is not None:
             logging.debug('Updating Sonarr search cache for search string "' + search_string + '" and language "' +
                           language + '": ' + str(len(results)) + ' Results')
-            instance = cls.get_cached_results(search_string=search_string, language=language)
             instance.date = datetime.datetime.now()
             instance.results = results
             db.session.commit()
@@ -74,162 +116,451 @@ class SonarrCache:
             )
             db.session.add(new_search)
             db.session.commit()
+        cls.search_memory.invalidate((search_string, language), (search_string, None))
+
+    @classmethod
+    def show_row(cls, tvdb_id, sonarr_format):
+        return {
+            'tvdb_id': tvdb_id,
+            'language': sonarr_format['language'],
+            'last_modified': datetime.datetime.now(),
+            'title': sonarr_format['title'],
+            'overview': sonarr_format['overview'],
+            'slug': sonarr_format['slug'],
+            'first_aired': sonarr_format['firstAired'],
+            'tv_rage_id': sonarr_format['tvRageId'],
+            'tv_maze_id': sonarr_format['tvMazeId'],
+            'status': sonarr_format['status'],
+            'runtime': sonarr_format['runtime'],
+            'time_of_day': sonarr_format['timeOfDay']['hours'],
+            'network': sonarr_format['network'],
+            'imdb_id': sonarr_format['imdbId'],
+            'actors': sonarr_format['actors'],
+            'genres': sonarr_format['genres'],
+            'content_rating': sonarr_format['contentRating'],
+            'rating_value': sonarr_format['rating']['value'],
+            'rating_count': sonarr_format['rating']['count'],
+            'images': sonarr_format['images'] if 'images' in sonarr_format else None
+        }
 
     @classmethod
+    def season_rows(cls, show_id, show_title, sonarr_format):
+        # Keyed on season number, the last duplicate wins. Postgres refuses to upsert the same row twice in one
+        # statement, and every season referenced by an episode needs a row before the episodes can be written.
+        seasons = {}
+        for season in sonarr_format['seasons']:
+            number = season['seasonNumber'] if 'seasonNumber' in season else 0
+            seasons[number] = {
+                'show_id': show_id,
+                'show_title': show_title,
+                'number': number,
+                'images': season['images'] if 'images' in season else None
+            }
+        for episode in sonarr_format['episodes']:
+            number = episode['seasonNumber'] if 'seasonNumber' in episode else 0
+            if number not in seasons:
+                seasons[number] = {
+                    'show_id': show_id,
+                    'show_title': show_title,
+                    'number': number,
+                    'images': None
+                }
+        return list(seasons.values())
+
+    @classmethod
+    def episode_rows(cls, show_id, show_title, season_ids, sonarr_format):
+        episodes = {}
+        for episode in assign_absolute_numbers(sonarr_format['episodes']):
+            season_number = episode['seasonNumber'] if 'seasonNumber' in episode else 0
+            number = episode['episodeNumber'] if 'episodeNumber' in episode else None
+            episodes[(season_number, number)] = {
+                'show_id': show_id,
+                'show_title': show_title,
+                'season_id': season_ids[season_number],
+                'season_number': season_number,
+                'tvdb_show_id': episode['tvdbShowId'] if 'tvdbShowId' in episode else None,
+                'tvdb_id': episode['tvdbId'] if 'tvdbId' in episode else None,
+                'number': number,
+                'absolute_number': episode['absoluteEpisodeNumber'] if 'absoluteEpisodeNumber' in episode else None,
+                'title': episode['title'] if 'title' in episode else None,
+                'air_date': episode['airDate'] if 'airDate' in episode else None,
+                'air_date_utc': episode['airDateUtc'] if 'airDateUtc' in episode else None,
+                'rating_count': episode['rating']['count'] if 'rating' in episode else None,
+                'rating_value': episode['rating']['value'] if 'rating' in episode else None,
+                'overview': episode['overview'] if 'overview' in episode else None,
+                'writers': episode['writers'] if 'writers' in episode else None,
+                'directors': episode['directors'] if 'directors' in episode else None,
+                'image': episode['image'] if 'image' in episode else None
+            }
+        return list(episodes.values())
+
+    @staticmethod
+    def upsert(model, rows, index_elements):
+        statement = insert(model.__table__).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_=dict((key, statement.excluded[key]) for key in rows[0] if key not in index_elements)
+        )
+
+    @classmethod
+    @stage_latency.time(stage='db_write')
     def update_show(cls, tvdb_id, sonarr_format):
-        language = sonarr_format['language']
+        # Writes the show graph (show, seasons, episodes) in a single transaction. Fresh rows are compared with the
+        # stored ones by content hash, only the rows that differ are inserted, updated or deleted. When anything
+        # changed the show moves to its next revision, written rows and deletions are stamped with it.
+        show_row = cls.show_row(tvdb_id, sonarr_format)
+        title = show_row['title']
+        language = show_row['language']
         try:
-            show = cls.get_cached_show(tvdb_id=tvdb_id, language=language)
-            show.title = sonarr_format['title']
-            show.slug = sonarr_format['slug']
-            show.overview = sonarr_format['overview']
-            show.first_aired = sonarr_format['firstAired']
-            show.tv_rage_id = sonarr_format['tvRageId']
-            show.tv_maze_id = sonarr_format['tvMazeId']
-            show.status = sonarr_format['status']
-            show.time_of_day = sonarr_format['timeOfDay']['hours']
-            show.network = sonarr_format['network']
-            show.imdb_id = sonarr_format['imdbId']
-            show.actors = sonarr_format['actors']
-            show.genres = sonarr_format['genres']
-            show.content_rating = sonarr_format['contentRating']
-            show.rating_value = sonarr_format['rating']['value']
-            show.rating_count = sonarr_format['rating']['count']
-            show.images = sonarr_format['images']
-            show.last_modified = datetime.datetime.now()
+            stored_shows = db.session.query(Show.id, Show.content_hash, Show.streamed, Show.graph_hash).filter_by(
+                tvdb_id=tvdb_id, language=language).all()
+            show_diff = RowDiff([show_row], dict(('show', (stored.id, stored.content_hash)) for stored in stored_shows),
+                                lambda row: 'show')
+            if show_diff.changed:
+                statement = cls.upsert(Show, show_diff.changed, ['tvdb_id', 'language']).returning(Show.__table__.c.id)
+                show_id = db.session.execute(statement).scalar()
+            else:
+                show_id = stored_shows[0].id
+                # Nothing but the refresh time to record
+                shows = Show.__table__
+                db.session.execute(shows.update()
+                                   .where(shows.c.tvdb_id == tvdb_id)
+                                   .where(shows.c.language == language)
+                                   .values(last_modified=show_row['last_modified']))
+
+            stored_seasons = db.session.query(Season.id, Season.number, Season.content_hash).filter_by(
+                show_id=show_id).all()
+            season_rows = cls.season_rows(show_id, title, sonarr_format)
+            season_diff = RowDiff(season_rows,
+                                  dict((number, (season_id, content_hash)) for season_id, number, content_hash in
+                                       stored_seasons),
+                                  lambda row: row['number'])
+            season_ids = dict((number, season_id) for season_id, number, content_hash in stored_seasons)
+            season_numbers = dict((season_id, number) for season_id, number, content_hash in stored_seasons)
+            revision = None
+            if show_diff.changed or season_diff.changed or season_diff.deletes:
+                revision = cls.next_revision(show_id)
+            if season_diff.changed:
+                for row in season_diff.changed:
+                    row['revision'] = revision
+                seasons = Season.__table__.c
+                statement = (cls.upsert(Season, season_diff.changed, ['show_id', 'number'])
+                             .returning(seasons.id, seasons.number))
+                for season_id, number in db.session.execute(statement):
+                    season_ids[number] = season_id
+
+            stored_episodes = db.session.query(Episode.id, Episode.season_id, Episode.number,
+                                               Episode.content_hash).filter_by(show_id=show_id)
+            episode_rows = cls.episode_rows(show_id, title, season_ids, sonarr_format)
+            episode_diff = RowDiff(episode_rows,
+                                   dict(((season_id, number), (episode_id, content_hash)) for
+                                        episode_id, season_id, number, content_hash in stored_episodes),
+                                   lambda row: (row['season_id'], row['number']))
+            if revision is None and (episode_diff.changed or episode_diff.deletes):
+                revision = cls.next_revision(show_id)
+            if episode_diff.deletes:
+                db.session.execute(Episode.__table__.delete().where(Episode.__table__.c.id.in_(episode_diff.deletes)))
+            if episode_diff.changed:
+                for row in episode_diff.changed:
+                    row['revision'] = revision
+                db.session.execute(cls.upsert(Episode, episode_diff.changed, ['season_id', 'number']))
+            if season_diff.deletes:
+                db.session.execute(Season.__table__.delete().where(Season.__table__.c.id.in_(season_diff.deletes)))
+
+            deletions = [{'show_id': show_id, 'revision': revision, 'season_number': number, 'episode_number': None}
+                         for number in season_diff.deleted_keys]
+            deletions.extend({'show_id': show_id, 'revision': revision, 'season_number': season_numbers[season_id],
+                              'episode_number': number} for season_id, number in episode_diff.deleted_keys)
+            if deletions:
+                db.session.execute(Deletion.__table__.insert().values(deletions))
+            if revision is not None:
+                cls.prune_deletions(show_id, revision)
+
+            # Decided here once per write, so reads never have to count episodes or read their hashes
+            streamed = len(episode_rows) > app.config['STREAM_SHOW_EPISODES']
+            streamed_changed = not stored_shows or stored_shows[0].streamed != streamed
+            graph_hash = combined_hash(row['content_hash'] for row in [show_row] + season_rows + episode_rows)
+            if streamed_changed or stored_shows[0].graph_hash != graph_hash:
+                shows = Show.__table__
+                db.session.execute(shows.update().where(shows.c.id == show_id).values(streamed=streamed,
+                                                                                      graph_hash=graph_hash))
+
+            changed = any(diff.changed or diff.deletes for diff in (show_diff, season_diff, episode_diff))
+            if changed or streamed_changed or not cls.touch_show_document(tvdb_id, language,
+                                                                          show_row['last_modified']):
+                # The writes bypass the ORM, drop anything the session still holds for this show before rendering.
+                db.session.expire_all()
+                show = db.session.query(Show).filter_by(tvdb_id=tvdb_id, language=language).one()
+                cls.store_show_document(show)
             db.session.commit()
-            logging.debug('Updated Sonarr show in cache: "' + show.title + '"')
-
-            for season in sonarr_format['seasons']:
-                number = season['seasonNumber'] if 'seasonNumber' in season else 0
-                if cls.has_season(show.title, number):
-                    cached_show = db.session.query(Season).filter_by(show_title=show.title, number=number).one()
-                    cached_show.images = season['images'] if 'images' in season else None
-                    db.session.commit()
-                    logging.debug('Updated Sonarr season to cache: "' + show.title + '" Season ' +
-                                  str(cached_show.number))
-                else:
-                    new_season = Season(
-                        show_title=show.title,
-                        number=number,
-                        images=season['images'] if 'images' in season else None
-                    )
-                    db.session.add(new_season)
-                    db.session.commit()
-                    logging.debug('Added new Sonarr season to cache: "' + show.title + '" Season ' +
-                                  str(new_season.number))
-
-            for episode in sonarr_format['episodes']:
-                season = episode['seasonNumber'] if 'seasonNumber' in episode else 0
-                number = episode['episodeNumber'] if 'episodeNumber' in episode else None
-                season = db.session.query(Season).filter_by(show_title=show.title, number=season).one()
-                if cls.has_episode(season.id, number):
-                    absolute_number = episode['absoluteEpisodeNumber'] if 'absoluteEpisodeNumber' in episode else None
-                    cached_episode = db.session.query(Episode).filter_by(season_id=season.id, number=number).one()
-                    cached_episode.tvdb_id = episode['tvdbId'] if 'tvdbId' in episode else None,
-                    cached_episode.absolute_number = absolute_number,
-                    cached_episode.title = episode['title'] if 'title' in episode else None,
-                    cached_episode.air_date = episode['airDate'] if 'airDate' in episode else None,
-                    cached_episode.air_date_utc = episode['airDateUtc'] if 'airDateUtc' in episode else None,
-                    cached_episode.rating_count = episode['rating']['count'] if 'rating' in episode else None,
-                    cached_episode.rating_value = episode['rating']['value'] if 'rating' in episode else None,
-                    cached_episode.overview = episode['overview'] if 'overview' in episode else None,
-                    cached_episode.writers = episode['writers'] if 'writers' in episode else None,
-                    cached_episode.directors = episode['directors'] if 'directors' in episode else None,
-                    cached_episode.image = episode['image'] if 'image' in episode else None
-                    db.session.commit()
-                    logging.debug('Updated Sonarr episode to cache: "' + show.title + '" Season ' +
-                                  str(season.number) + ' Episode ' + str(cached_episode.number) + ' [Absolute number: ' + str(cached_episode.absolute_number) + ']')
-                else:
-                    absolute_number = episode['absoluteEpisodeNumber'] if 'absoluteEpisodeNumber' in episode else None
-                    new_episode = Episode(
-                        show_title=show.title,
-                        season_id=season.id,
-                        tvdb_show_id=episode['tvdbShowId'] if 'tvdbShowId' in episode else None,
-                        tvdb_id=episode['tvdbId'] if 'tvdbId' in episode else None,
-                        number=number,
-                        absolute_number=absolute_number,
-                        title=episode['title'] if 'title' in episode else None,
-                        air_date=episode['airDate'] if 'airDate' in episode else None,
-                        air_date_utc=episode['airDateUtc'] if 'airDateUtc' in episode else None,
-                        rating_count=episode['rating']['count'] if 'rating' in episode else None,
-                        rating_value=episode['rating']['value'] if 'rating' in episode else None,
-                        overview=episode['overview'] if 'overview' in episode else None,
-                        writers=episode['writers'] if 'writers' in episode else None,
-                        directors=episode['directors'] if 'directors' in episode else None,
-                        image=episode['image'] if 'image' in episode else None
-                    )
-                    db.session.add(new_episode)
-                    db.session.commit()
-                    logging.debug('Added new Sonarr episode to cache: "' + show.title + '" Season ' +
-                                  str(season.number) + ' Episode ' + str(new_episode.number) + ' [Absolute number: ' + str(new_episode.absolute_number) + ']')
-        except NoResultFound:
-            new_show = Show(
-                tvdb_id=tvdb_id,
-                language=language,
-                title=sonarr_format['title'],
-                overview=sonarr_format['overview'],
-                slug=sonarr_format['slug'],
-                first_aired=sonarr_format['firstAired'],
-                tv_rage_id=sonarr_format['tvRageId'],
-                tv_maze_id=sonarr_format['tvMazeId'],
-                status=sonarr_format['status'],
-                runtime=sonarr_format['runtime'],
-                time_of_day=sonarr_format['timeOfDay']['hours'],
-                network=sonarr_format['network'],
-                imdb_id=sonarr_format['imdbId'],
-                actors=sonarr_format['actors'],
-                genres=sonarr_format['genres'],
-                content_rating=sonarr_format['contentRating'],
-                rating_value=sonarr_format['rating']['value'],
-                rating_count=sonarr_format['rating']['count'],
-                images=sonarr_format['images']
-            )
-            db.session.add(new_show)
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.forget_show(tvdb_id, language)
+        cls.search_index.add((int(tvdb_id), language), title, show_row['slug'])
+
+        changes = {}
+        for table, diff in (('shows', show_diff), ('seasons', season_diff), ('episodes', episode_diff)):
+            cls.row_changes.add(table, diff)
+            changes[table] = diff.counts()
+        logging.debug('Updated Sonarr show in cache: "' + title + '" (episodes: ' +
+                      str(changes['episodes']['inserted']) + ' inserted, ' +
+                      str(changes['episodes']['updated']) + ' updated, ' +
+                      str(changes['episodes']['deleted']) + ' deleted, ' +
+                      str(changes['episodes']['unchanged']) + ' unchanged)')
+        return changes
+
+    @classmethod
+    def next_revision(cls, show_id):
+        # The show row is locked by this transaction from its upsert on, so revisions of a show follow commit order
+        shows = Show.__table__
+        statement = shows.update().where(shows.c.id == show_id).values(revision=shows.c.revision + 1)
+        return db.session.execute(statement.returning(shows.c.revision)).scalar()
+
+    @classmethod
+    def prune_deletions(cls, show_id, revision):
+        # Drops the deletions older than the last DELTA_KEEP_REVISIONS revisions, deltas from before them can't be
+        # answered anymore and get the whole show
+        delta_since = revision - app.config['DELTA_KEEP_REVISIONS']
+        if delta_since <= 0:
+            return
+        deletions = Deletion.__table__
+        db.session.execute(deletions.delete()
+                           .where(deletions.c.show_id == show_id)
+                           .where(deletions.c.revision <= delta_since))
+        shows = Show.__table__
+        db.session.execute(shows.update().where(shows.c.id == show_id).values(delta_since=delta_since))
+
+    @classmethod
+    def touch_show_document(cls, tvdb_id, language, last_modified):
+        # Moves the stored document's refresh time forward, returns False when there is no document to move
+        documents = ShowDocument.__table__
+        result = db.session.execute(documents.update()
+                                    .where(documents.c.tvdb_id == tvdb_id)
+                                    .where(documents.c.language == language)
+                                    .values(last_modified=last_modified))
+        return result.rowcount > 0
+
+    @classmethod
+    @stage_latency.time(stage='render')
+    def store_show_document(cls, show):
+        # Shows with more than STREAM_SHOW_EPISODES episodes get no document, they are streamed from their rows on
+        # every request instead of crowding everything else out of the memory cache. Returns the document or None.
+        if show.streamed is None:
+            # Written before update_show recorded it, counted this once
+            show.streamed = show.episode_count() > app.config['STREAM_SHOW_EPISODES']
+        if show.streamed:
+            documents = ShowDocument.__table__
+            db.session.execute(documents.delete()
+                               .where(documents.c.tvdb_id == show.tvdb_id)
+                               .where(documents.c.language == show.language))
+            return None
+        document = ''.join(show.iter_sonarr_json(app.config['STREAM_EPISODE_BATCH'])).encode('utf-8')
+        etag = strong_etag(document)
+        documents = ShowDocument.__table__
+        statement = insert(documents).values(
+            tvdb_id=show.tvdb_id,
+            language=show.language,
+            last_modified=show.last_modified,
+            document=document,
+            etag=etag,
+            changed=datetime.datetime.utcnow()
+        )
+        changed = db.session.execute(statement.on_conflict_do_update(
+            index_elements=['tvdb_id', 'language'],
+            set_={
+                'last_modified': statement.excluded.last_modified,
+                'document': statement.excluded.document,
+                'etag': statement.excluded.etag,
+                # A document rendered to the same bytes hasn't changed for the clients that have it
+                'changed': case([(documents.c.etag == statement.excluded.etag, documents.c.changed)],
+                                else_=statement.excluded.changed)
+            }
+        ).returning(documents.c.changed)).scalar()
+        return CachedDocument(document, etag, changed)
+
+    @classmethod
+    def forget_show(cls, tvdb_id, language):
+        cls.show_memory.invalidate((str(tvdb_id), language), (str(tvdb_id), None))
+
+    @classmethod
+    def get_show_document(cls, tvdb_id, language, check_date=True):
+        # Returns the CachedDocument of a cached show, or None when it is missing or past its cache time.
+        memory_key = (str(tvdb_id), language)
+        document = cls.show_memory.get(memory_key)
+        if document is not None:
+            tag_lookup('show_memory', 'hit')
+            return document
+
+        documents = db.session.query(ShowDocument.language, ShowDocument.last_modified, ShowDocument.document,
+                                     ShowDocument.etag, ShowDocument.changed)
+        result = None
+        if language is None:
+            cached_results = cls.map_languages(documents.filter_by(tvdb_id=tvdb_id))
+            for language in app.config['TVDB_LANGUAGES']:
+                if language in cached_results:
+                    result = cached_results[language]
+                    break
+        else:
+            result = documents.filter_by(tvdb_id=tvdb_id, language=language).first()
+
+        if result is None:
+            record_lookup('show_document', 'miss')
+            logging.debug('No Sonarr show document found for TVDB ID "' + str(tvdb_id) + '"')
+            return None
+        last_modified_difference = (datetime.datetime.now() - result.last_modified).total_seconds()
+        if check_date and last_modified_difference > app.config['SHOW_CACHE_TIME']:
+            record_lookup('show_document', 'stale')
+            logging.debug('Sonarr show document for TVDB ID "' + str(tvdb_id) + '" is past its cache time')
+            return None
+        record_lookup('show_document', 'hit')
+        # Documents stored before they had validators are hashed here
+        document = CachedDocument(result.document, result.etag or strong_etag(result.document), result.changed)
+        cls.show_memory.set(memory_key, document, app.config['SHOW_CACHE_TIME'] - last_modified_difference)
+        logging.debug('Found Sonarr show document for TVDB ID "' + str(tvdb_id) + '" and language "' +
+                      result.language + '"')
+        return document
+
+    @classmethod
+    def get_cached_document(cls, tvdb_id, language, update_show=True):
+        # The CachedDocument of a show, or the Show itself when it is streamed (see store_show_document) so it
+        # doesn't have to be looked up again
+        document = cls.get_show_document(tvdb_id, language, check_date=update_show)
+        if document is not None:
+            return document
+        show = cls.get_cached_show(tvdb_id, language, update_show)
+        if show.streamed:
+            return show
+        document = cls.get_show_document(show.tvdb_id, show.language, check_date=False)
+        if document is None:
+            # Shows cached before documents existed, or before streamed was recorded, are sorted out once on first
+            # request
+            document = cls.store_show_document(show)
             db.session.commit()
-            logging.debug('Added new Sonarr show to cache: "' + new_show.title + '"')
-
-            for season in sonarr_format['seasons']:
-                number = season['seasonNumber'] if 'seasonNumber' in season else 0
-                if cls.has_season(new_show.title, number):
-                    continue
-                new_season = Season(
-                    show_title=new_show.title,
-                    number=number,
-                    images=season['images'] if 'images' in season else None
-                )
-                db.session.add(new_season)
-                db.session.commit()
-                logging.debug('Added new Sonarr season to cache: "' + new_show.title + '" Season ' +
-                              str(new_season.number))
-
-            for episode in sonarr_format['episodes']:
-                season = episode['seasonNumber'] if 'seasonNumber' in episode else 0
-                number = episode['episodeNumber'] if 'episodeNumber' in episode else None
-                season = db.session.query(Season).filter_by(show_title=new_show.title, number=season).one()
-                if cls.has_episode(season.id, number):
-                    continue
-                new_episode = Episode(
-                    show_title=new_show.title,
-                    season_id=season.id,
-                    tvdb_show_id=episode['tvdbShowId'] if 'tvdbShowId' in episode else None,
-                    tvdb_id=episode['tvdbId'] if 'tvdbId' in episode else None,
-                    number=number,
-                    absolute_number=episode['absoluteEpisodeNumber'] if 'absoluteEpisodeNumber' in episode else None,
-                    title=episode['title'] if 'title' in episode else None,
-                    air_date=episode['airDate'] if 'airDate' in episode else None,
-                    air_date_utc=episode['airDateUtc'] if 'airDateUtc' in episode else None,
-                    rating_count=episode['rating']['count'] if 'rating' in episode else None,
-                    rating_value=episode['rating']['value'] if 'rating' in episode else None,
-                    overview=episode['overview'] if 'overview' in episode else None,
-                    writers=episode['writers'] if 'writers' in episode else None,
-                    directors=episode['directors'] if 'directors' in episode else None,
-                    image=episode['image'] if 'image' in episode else None
-                )
-                db.session.add(new_episode)
-                db.session.commit()
-                logging.debug('Added new Sonarr episode to cache: "' + new_show.title + '" Season ' +
-                              str(season.number) + ' Episode ' + str(new_episode.number) + ' [Absolute number: ' + str(new_episode.absolute_number) + ']')
+            cls.forget_show(show.tvdb_id, show.language)
+            if document is None:
+                return show
+        return document
+
+    @classmethod
+    def get_show_etag(cls, show):
+        # Streamed shows have no document to hash, the hash of their rows kept by update_show stands in for it. None
+        # for shows not written since it is kept.
+        return show.graph_hash
+
+    @classmethod
+    def pick_languages(cls, rows, language):
+        # {tvdb_id: row} of rows for many shows, keeping the row in the first of the configured languages
+        languages = [language] if language is not None else app.config['TVDB_LANGUAGES']
+        picked = {}
+        for row in rows:
+            if row.language not in languages:
+                continue
+            rank = languages.index(row.language)
+            if row.tvdb_id not in picked or rank < picked[row.tvdb_id][0]:
+                picked[row.tvdb_id] = (rank, row)
+        return dict((tvdb_id, row) for tvdb_id, (rank, row) in picked.items())
+
+    @classmethod
+    def get_cached_documents(cls, tvdb_ids, language):
+        # get_show_document for many shows at once: memory first, then one query for the rest. Returns
+        # {tvdb_id: (CachedDocument, seconds since the show was refreshed)}, including documents past their cache time.
+        found = {}
+        missing = []
+        for tvdb_id in tvdb_ids:
+            document = cls.show_memory.get((str(tvdb_id), language))
+            if document is not None:
+                found[tvdb_id] = (document, 0)
+            else:
+                missing.append(tvdb_id)
+        if not missing:
+            return found
+
+        documents = (db.session.query(ShowDocument.tvdb_id, ShowDocument.language, ShowDocument.last_modified,
+                                      ShowDocument.document, ShowDocument.etag, ShowDocument.changed)
+                     .filter(ShowDocument.tvdb_id.in_(missing))
+                     )
+        now = datetime.datetime.now()
+        for tvdb_id, result in cls.pick_languages(documents, language).items():
+            age = (now - result.last_modified).total_seconds()
+            document = CachedDocument(result.document, result.etag or strong_etag(result.document), result.changed)
+            if age <= app.config['SHOW_CACHE_TIME']:
+                cls.show_memory.set((str(tvdb_id), language), document, app.config['SHOW_CACHE_TIME'] - age)
+            found[tvdb_id] = (document, age)
+        return found
+
+    @classmethod
+    def find_shows(cls, tvdb_ids, language, refresh=False):
+        # find_show for many shows at once, {tvdb_id: Show}
+        if not tvdb_ids:
+            return {}
+        shows = db.session.query(Show)
+        if refresh:
+            shows = shows.populate_existing()
+        return cls.pick_languages(shows.filter(Show.tvdb_id.in_(tvdb_ids)), language)
+
+    @classmethod
+    def fetch_shows(cls, tvdb_ids, language):
+        # fetch_show for many shows, BATCH_FETCH_WORKERS at a time over all requests. Returns {tvdb_id: result}, the
+        # result being whether the show was written or the exception fetching it raised.
+        futures = [(tvdb_id, batch_fetcher.submit(fetch_show_in_context, tvdb_id, language)) for tvdb_id in tvdb_ids]
+        results = {}
+        for tvdb_id, future in futures:
+            try:
+                results[tvdb_id] = future.result()
+            except Exception as e:
+                logging.warning('Fetching show with TVDB ID "' + str(tvdb_id) + '" failed: ' + str(e))
+                results[tvdb_id] = e
+        return results
+
+    @classmethod
+    def get_cached_batch(cls, tvdb_ids, language):
+        # get_cached_show(update_show=True) for many shows. Fresh shows are served as they are, stale ones as well
+        # while they refresh in the background, missing and expired ones are fetched before answering. Returns
+        # [(tvdb_id, status, CachedDocument or Show (streamed shows) or None)] in the order of tvdb_ids, status being
+        # one of cached, stale, fetched, not_found or error.
+        documents = cls.get_cached_documents(tvdb_ids, language)
+        shows = cls.find_shows([tvdb_id for tvdb_id in tvdb_ids if tvdb_id not in documents], language)
+        entries = {}
+        for tvdb_id in tvdb_ids:
+            if tvdb_id in documents:
+                entries[tvdb_id] = documents[tvdb_id]
+            elif tvdb_id in shows:
+                show = shows[tvdb_id]
+                entries[tvdb_id] = (show, (datetime.datetime.now() - show.last_modified).total_seconds())
+
+        results = {}
+        fetch = []
+        for tvdb_id in tvdb_ids:
+            if tvdb_id not in entries or entries[tvdb_id][1] >= app.config['SHOW_HARD_EXPIRY_TIME']:
+                fetch.append(tvdb_id)
+            elif entries[tvdb_id][1] > app.config['SHOW_CACHE_TIME']:
+                show_refresher.schedule(str(tvdb_id))
+                results[tvdb_id] = ('stale', entries[tvdb_id][0])
+            else:
+                results[tvdb_id] = ('cached', entries[tvdb_id][0])
+        if not fetch:
+            return [(tvdb_id, results[tvdb_id][0], results[tvdb_id][1]) for tvdb_id in tvdb_ids]
+
+        fetched = cls.fetch_shows(fetch, language)
+        written = [tvdb_id for tvdb_id in fetch if fetched[tvdb_id] is True]
+        for tvdb_id in written:
+            cls.forget_show(tvdb_id, language)
+        documents = cls.get_cached_documents(written, language)
+        shows = cls.find_shows([tvdb_id for tvdb_id in written if tvdb_id not in documents], language, refresh=True)
+        for tvdb_id in fetch:
+            if tvdb_id in documents:
+                results[tvdb_id] = ('fetched', documents[tvdb_id][0])
+            elif tvdb_id in shows:
+                results[tvdb_id] = ('fetched', shows[tvdb_id])
+            elif tvdb_id in entries:
+                # Like get_cached_show, an expired show beats no show when the update fails
+                results[tvdb_id] = ('stale', entries[tvdb_id][0])
+            elif isinstance(fetched[tvdb_id], Exception):
+                results[tvdb_id] = ('error', None)
+            else:
+                results[tvdb_id] = ('not_found', None)
+        return [(tvdb_id, results[tvdb_id][0], results[tvdb_id][1]) for tvdb_id in tvdb_ids]
 
     @classmethod
     def map_languages(cls, shows):
@@ -238,52 +569,91 @@ class SonarrCache:
             mapped_shows[show.language] = show
         return mapped_shows
 
+    @classmethod
+    def find_show(cls, tvdb_id, language, refresh=False):
+        shows = db.session.query(Show)
+        if refresh:
+            # Another thread or process may have just rewritten the show
+            shows = shows.populate_existing()
+        if language is None:
+            cached_results = cls.map_languages(shows.filter_by(tvdb_id=tvdb_id))
+            for language in app.config['TVDB_LANGUAGES']:
+                if language in cached_results:
+                    return cached_results[language]
+            return None
+        return shows.filter_by(tvdb_id=tvdb_id, language=language).one()
+
+    @classmethod
+    def fetch_show(cls, tvdb_id, language):
+        # Grabs the show from upstream by TVDB ID. Concurrent fetches of the same show share one upstream fetch within
+        # this process and wait on each other across processes. Returns whether the show was (re)written.
+        return cls.show_flights.do(('show', str(tvdb_id), language), cls.fetch_show_once, tvdb_id, language)
+
+    @classmethod
+    def fetch_show_once(cls, tvdb_id, language):
+        started = datetime.datetime.now()
+        with advisory_lock('show:' + str(tvdb_id) + ':' + str(language)):
+            for last_modified, in db.session.query(Show.last_modified).filter_by(tvdb_id=tvdb_id):
+                if last_modified >= started:
+                    logging.debug('Show with TVDB ID "' + str(tvdb_id) + '" was updated by another worker')
+                    return True
+            search_results = tvdb.search(None, None, tvdb_id=tvdb_id)
+            if search_results is None:
+                return False
+            handle_search(tvdb_id, search_results)
+            return True
+
     @classmethod
     def get_cached_show(cls, tvdb_id, language, update_show=False):
         try:
-            result = None
-            if language is None:
-                cached_results = cls.map_languages(db.session.query(Show).filter_by(tvdb_id=tvdb_id))
-                for language in app.config['TVDB_LANGUAGES']:
-                    if language in cached_results:
-                        result = cached_results[language]
-                        break
-            else:
-                result = db.session.query(Show).filter_by(tvdb_id=tvdb_id, language=language)
-                if result is not None:
-                     result = result.one()
+            result = cls.find_show(tvdb_id, language)
+            # Recorded once the show is known to be fresh, stale or expired
+            lookup = 'hit'
 
             # Update cached show by grabbing the show from tv maze by tvdb id.
             if result is None:
+                record_lookup('show', 'miss')
+                lookup = None
                 logging.debug('Trying to grab show from TV maze with TVDB ID: ' + str(tvdb_id))
-                search_results = tvdb.search(None, None, tvdb_id=tvdb_id)
-                if search_results is not None:
-                    search_result = handle_search(tvdb_id, search_results)[0]
-                    return search_result
+                if cls.fetch_show(tvdb_id, language):
+                    result = cls.find_show(tvdb_id, language, refresh=True)
             if result is None:
                 logging.error('Cached Sonarr show not found for TVDB ID "' + str(tvdb_id))
                 raise CacheShowLanguage
 
             if update_show:
                 last_modified_difference = (datetime.datetime.now() - result.last_modified).total_seconds()
-                if last_modified_difference > app.config['SHOW_CACHE_TIME']:
+                if app.config['SHOW_CACHE_TIME'] < last_modified_difference < app.config['SHOW_HARD_EXPIRY_TIME']:
+                    lookup = 'stale'
+                    # Serve the stale show right away and let a background worker bring it up to date
+                    if show_refresher.schedule(str(tvdb_id)):
+                        logging.debug('Scheduled background refresh for TVDB ID "' + str(tvdb_id) + '"')
+                elif last_modified_difference > app.config['SHOW_CACHE_TIME']:
+                    record_lookup('show', 'expired')
+                    lookup = None
                     logging.debug('Cached Sonarr show last modified date too long ago: ' + str(last_modified_difference) + ' seconds, attempting to update show info')
-                    search_results = tvdb.search(None, None, tvdb_id=tvdb_id)
-                    if search_results is not None:
-                        search_result = handle_search(tvdb_id, search_results)[0]
+                    if cls.fetch_show(tvdb_id, language):
                         logging.debug('Found updated show information for TVDB ID "' + str(tvdb_id) + '", returning updated show info')
-                        return search_result
+                        return cls.find_show(tvdb_id, language, refresh=True)
                     else:
                         logging.debug('Unable to update show information, returning cached show instead')
-            logging.debug('Found cached Sonarr show for TVDB ID "' + str(tvdb_id) + '" and language "' + language + '"')
+            if lookup is not None:
+                record_lookup('show', lookup)
+            logging.debug('Found cached Sonarr show for TVDB ID "' + str(tvdb_id) + '" and language "' +
+                          result.language + '"')
             return result
         except NoResultFound:
             raise NoResultFound('No cached Sonarr show found for TVDB ID "' + str(tvdb_id) + '" and language "' +
-                                language + '"')
+                                str(language) + '"')
 
     @classmethod
     def has_cached_results(cls, search_string, language=None, check_date=True):
         search_string = search_string.lower()
+        memory_key = (search_string, language)
+        if cls.search_memory.get(memory_key) is not None:
+            tag_lookup('search_memory', 'hit')
+            logging.debug('Found in-memory Sonarr search result for "' + search_string + '"')
+            return True
         try:
             if language is None:
                 result = None
@@ -296,18 +666,23 @@ class SonarrCache:
                 result = db.session.query(Search).filter_by(search_string=search_string, language=language).one()
 
             if result is None:
+                record_lookup('search', 'miss')
                 logging.debug('Did not find any Sonarr cached search results for "' + str(search_string) +
                               '" and language "' + (language if language is not None else 'None') + '"')
                 return False
             elif check_date and (result.date + datetime.timedelta(0, app.config['SEARCH_CACHE_TIME']) < datetime.datetime.now(pytz.utc)):
+                record_lookup('search', 'stale')
                 logging.debug('Found cached Sonarr search result for "' + str(search_string) + '" and language "' +
                               (language if language is not None else 'None') + '", but cache time was past')
                 return False
             else:
+                record_lookup('search', 'hit')
                 logging.debug('Found cached Sonarr search result for "' + str(search_string) + '" and language "' +
                               (language if language is not None else 'None') + '"')
+                cls.remember_search(memory_key, result)
                 return True
         except NoResultFound:
+            record_lookup('search', 'miss')
             logging.debug('No cached Sonarr search result found for "' + str(search_string) + '" and language "' +
                           (language if language is not None else 'None') + '"')
             return False
@@ -315,6 +690,10 @@ class SonarrCache:
     @classmethod
     def get_cached_results(cls, search_string, language=None):
         search_string = search_string.lower()
+        memory_key = (search_string, language)
+        cached_search = cls.search_memory.get(memory_key, record=False)
+        if cached_search is not None:
+            return cached_search
         try:
             if language is None:
                 result = None
@@ -327,7 +706,72 @@ class SonarrCache:
                 result = db.session.query(Search).filter_by(search_string=search_string, language=language).one()
             logging.debug('Returning cached Sonarr search results for "' + str(search_string) + ' and language "' +
                           (language if language is not None else 'None') + '"')
-            return result
+            if result is None:
+                raise NoResultFound
+            return cls.remember_search(memory_key, result)
         except NoResultFound:
             logging.error('Failed to get cached Sonarr search results for "' + str(search_string) + '"')
             raise NoResultFound
+
+    @classmethod
+    def sync_search_index(cls):
+        # Loads every cached show the first time, then the shows written since the last sync (by any worker)
+        now = datetime.datetime.now()
+        synced = cls.search_index.synced
+        if synced is not None and (now - synced).total_seconds() < app.config['SEARCH_INDEX_SYNC_INTERVAL']:
+            return
+        cls.search_index.synced = now
+        shows = db.session.query(Show.tvdb_id, Show.language, Show.title, Show.slug)
+        if synced is not None:
+            # Overlap the previous sync, shows are stamped before their transaction commits
+            shows = shows.filter(Show.last_modified >= synced - datetime.timedelta(seconds=60))
+        count = 0
+        for tvdb_id, language, title, slug in shows:
+            cls.search_index.add((tvdb_id, language), title, slug)
+            count += 1
+        logging.debug('Synced ' + str(count) + ' shows into the search index (' + str(len(cls.search_index)) +
+                      ' indexed)')
+
+    @classmethod
+    def search_index_matches(cls, search_string, language, min_score):
+        # [(tvdb_id, language)] of cached shows matching the search, best first and one language per show
+        cls.sync_search_index()
+        matches = cls.search_index.search(search_string, min_score, limit=app.config['SEARCH_INDEX_LIMIT'] * 4)
+        languages = [language] if language is not None else app.config['TVDB_LANGUAGES']
+        best = {}
+        for score, (tvdb_id, show_language) in matches:
+            if show_language not in languages:
+                continue
+            rank = (-score, languages.index(show_language))
+            if tvdb_id not in best or rank < best[tvdb_id][0]:
+                best[tvdb_id] = (rank, show_language)
+        ranked = sorted(best.items(), key=lambda item: item[1][0])
+        ranked = ranked[:app.config['SEARCH_INDEX_LIMIT']]
+        return [(tvdb_id, show_language) for tvdb_id, (rank, show_language) in ranked]
+
+    @classmethod
+    def remember_search(cls, memory_key, result):
+        cached_search = CachedSearch(result.search_string, result.language, result.date, result.results)
+        expires = result.date + datetime.timedelta(0, app.config['SEARCH_CACHE_TIME'])
+        cls.search_memory.set(memory_key, cached_search, (expires - datetime.datetime.now(pytz.utc)).total_seconds())
+        return cached_search
+
+
+def refresh_show(tvdb_id):
+    if SonarrCache.fetch_show(tvdb_id, None):
+        logging.debug('Refreshed show information for TVDB ID "' + str(tvdb_id) + '"')
+    else:
+        logging.debug('Unable to refresh show information for TVDB ID "' + str(tvdb_id) + '"')
+
+
+def fetch_show_in_context(tvdb_id, language):
+    with app.app_context():
+        try:
+            return SonarrCache.fetch_show(tvdb_id, language)
+        finally:
+            db.session.remove()
+
+
+show_refresher = Refresher(refresh_show, app.config['REFRESH_WORKERS'])
+batch_fetcher = ThreadPoolExecutor(max_workers=app.config['BATCH_FETCH_WORKERS'])
+prewarmer = Prewarmer(show_refresher, app.config['PREWARM_INTERVAL'], app.config['PREWARM_BUDGET'])
@@ -0,0 +1,95 @@
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+
+from skyhook import app, db
+from skyhook.logger import Logger
+from sqlalchemy import text
+
+logging = Logger(__name__)
+
+# First half of every two-key Postgres advisory lock taken by Skyhook, keeps them apart from other applications
+ADVISORY_LOCK_NAMESPACE = 0x5350
+# Seconds between attempts to take an advisory lock held by another process
+ADVISORY_LOCK_POLL = 0.1
+
+
+class Flight(object):
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    # Concurrent calls with the same key share one execution: the first caller runs the function and every caller
+    # that arrives while it runs waits for it and gets the same result (or exception).
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, function, *args):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = function(*args)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.flights[key]
+            flight.event.set()
+
+    def in_flight(self):
+        with self.lock:
+            return len(self.flights)
+
+
+@contextmanager
+def advisory_lock(key):
+    # Session level Postgres advisory lock on a dedicated connection, so it serializes work across uwsgi processes
+    # and survives the commits made while holding it. A lock held elsewhere is waited for up to UPSTREAM_LOCK_TIMEOUT
+    # seconds, then the body runs without it: the work is done twice instead of everyone waiting on a hung holder.
+    # Yields whether the lock is held.
+    lock_id = zlib.crc32(key.encode('utf-8'))
+    if lock_id >= 2 ** 31:
+        lock_id -= 2 ** 32
+    deadline = time.time() + app.config['UPSTREAM_LOCK_TIMEOUT']
+    connection = db.engine.connect()
+    locked = False
+    try:
+        while True:
+            locked = connection.execute(text('SELECT pg_try_advisory_lock(:namespace, :lock_id)'),
+                                        namespace=ADVISORY_LOCK_NAMESPACE, lock_id=lock_id).scalar()
+            if locked or time.time() >= deadline:
+                break
+            time.sleep(ADVISORY_LOCK_POLL)
+    finally:
+        if not locked:
+            connection.close()
+
+    if not locked:
+        logging.warning('Gave up waiting for lock "' + key + '", going on without it')
+        yield False
+        return
+    try:
+        yield True
+    finally:
+        try:
+            connection.execute(text('SELECT pg_advisory_unlock(:namespace, :lock_id)'),
+                               namespace=ADVISORY_LOCK_NAMESPACE, lock_id=lock_id)
+        finally:
+            connection.close()
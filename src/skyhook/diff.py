@@ -0,0 +1,67 @@
+import hashlib
+import json
+import threading
+
+
+def content_hash(row, exclude=('last_modified',)):
+    # Stable across processes and restarts: keys are sorted and dates are hashed as their string form
+    content = dict((key, value) for key, value in row.items() if key not in exclude)
+    return hashlib.sha1(json.dumps(content, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def combined_hash(hashes):
+    # One hash for a set of content hashes, whatever order they come in
+    return hashlib.sha1(' '.join(sorted(hashes)).encode('utf-8')).hexdigest()
+
+
+class RowDiff(object):
+    # Compares the rows freshly built for one show with the stored ones, given as {key: (id, content_hash)}. Rows get
+    # their content_hash set, stored rows that no longer have a fresh counterpart end up in deletes (by id) and
+    # deleted_keys.
+    def __init__(self, rows, stored, key):
+        self.inserts = []
+        self.updates = []
+        self.unchanged = 0
+        keys = set()
+        for row in rows:
+            row_key = key(row)
+            keys.add(row_key)
+            row['content_hash'] = content_hash(row)
+            stored_row = stored.get(row_key)
+            if stored_row is None:
+                self.inserts.append(row)
+            elif stored_row[1] != row['content_hash']:
+                self.updates.append(row)
+            else:
+                self.unchanged += 1
+        self.deleted_keys = [row_key for row_key in stored if row_key not in keys]
+        self.deletes = [stored[row_key][0] for row_key in self.deleted_keys]
+
+    @property
+    def changed(self):
+        return self.inserts + self.updates
+
+    def counts(self):
+        return {
+            'inserted': len(self.inserts),
+            'updated': len(self.updates),
+            'deleted': len(self.deletes),
+            'unchanged': self.unchanged
+        }
+
+
+class ChangeCounter(object):
+    # Running totals of RowDiff counts per table since the process started
+    def __init__(self):
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def add(self, table, diff):
+        with self.lock:
+            totals = self.totals.setdefault(table, {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0})
+            for kind, count in diff.counts().items():
+                totals[kind] += count
+
+    def stats(self):
+        with self.lock:
+            return dict((table, dict(totals)) for table, totals in self.totals.items())
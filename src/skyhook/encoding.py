@@ -0,0 +1,25 @@
+import hashlib
+import zlib
+
+
+def strong_etag(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def gzip_compressor(level):
+    # gzip framing without a timestamp, the same body always compresses to the same bytes
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_bytes(data, level):
+    compressor = gzip_compressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_gzip(chunks, level):
+    compressor = gzip_compressor(level)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    # Bounded in-process cache, entries expire after their own TTL and the least recently used ones are evicted once
+    # the total weight (entry count by default, e.g. bytes when a weigh function is given) goes over maxsize.
+    def __init__(self, maxsize, ttl, weigh=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.weigh = weigh
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None, record=True):
+        # record=False looks an entry up without touching the hit/miss counters
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self.remove(key)
+                entry = None
+            if entry is None:
+                if record:
+                    self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            if record:
+                self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        weight = self.weigh(value) if self.weigh is not None else 1
+        if ttl <= 0 or weight > self.maxsize:
+            return
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = (time.monotonic() + ttl, value, weight)
+            self.weight += weight
+            while self.weight > self.maxsize:
+                self.remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.weight = 0
+
+    def remove(self, key):
+        # Callers hold the lock
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'weight': self.weight,
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
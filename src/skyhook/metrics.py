@@ -0,0 +1,170 @@
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from a memory cache hit to a slow upstream
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(name + '="' + escape(value) + '"' for name, value in pairs) + '}'
+
+
+class Metric(object):
+    # Values are kept per combination of label values, in the order the labels were declared. function, when given,
+    # is called on every scrape instead and returns {(label values): value}, for numbers kept elsewhere.
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def render(self):
+        lines = ['# HELP ' + self.name + ' ' + self.documentation, '# TYPE ' + self.name + ' ' + self.kind]
+        for name, key, extra, value in self.samples():
+            lines.append(name + format_labels(self.labels, key, extra) + ' ' + format_value(value))
+        return lines
+
+    def samples(self):
+        # [(sample name, label values, extra label pairs, value)]
+        if self.function is not None:
+            return [(self.name, tuple(str(label) for label in key), (), value)
+                    for key, value in sorted(self.function().items())]
+        with self.lock:
+            return [(self.name, key, (), value) for key, value in sorted(self.values.items())]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket, then the sum
+                counts = self.values[key] = [0] * len(self.buckets) + [0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        # Also works as a decorator
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    samples.append((self.name + '_bucket', key, [('le', format_value(bound))], cumulative))
+                samples.append((self.name + '_sum', key, (), counts[-1]))
+                samples.append((self.name + '_count', key, (), cumulative))
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labels=(), function=None):
+        return self.register(Counter(name, documentation, labels, function))
+
+    def gauge(self, name, documentation, labels=(), function=None):
+        return self.register(Gauge(name, documentation, labels, function))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, documentation, labels, buckets))
+
+    def render(self):
+        # Prometheus text exposition format 0.0.4
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_latency = registry.histogram('skyhook_request_duration_seconds',
+                                     'Time to answer a request, including streamed bodies.',
+                                     ['endpoint', 'status'])
+requests_in_flight = registry.gauge('skyhook_requests_in_flight', 'Requests being served.', ['endpoint'])
+db_queries = registry.histogram('skyhook_db_queries_per_request', 'Database statements executed per request.',
+                                ['endpoint'], buckets=COUNT_BUCKETS)
+db_query_latency = registry.histogram('skyhook_db_query_duration_seconds', 'Time spent executing database statements.')
+stage_latency = registry.histogram('skyhook_stage_duration_seconds', 'Time spent per processing stage.', ['stage'])
+upstream_latency = registry.histogram('skyhook_upstream_request_duration_seconds',
+                                      'Time spent on upstream HTTP requests, cached responses excluded.',
+                                      ['host', 'client'])
+upstream_errors = registry.counter('skyhook_upstream_errors_total', 'Upstream HTTP requests that failed.',
+                                   ['host', 'client'])
+cache_lookups = registry.counter('skyhook_cache_lookups_total',
+                                 'Search and show lookups in Postgres by result (hit, stale, expired or miss).',
+                                 ['cache', 'result'])
@@ -0,0 +1,98 @@
+from sqlalchemy import text
+
+# Schema changes to tables that already exist, db.create_all() only creates missing tables (with their indexes).
+# Each entry is one schema version, applied once and recorded in skyhook_schema_version. A new database is created at
+# the latest schema and then runs every version too, so the statements have to be no-ops on it.
+MIGRATIONS = [
+    # 1: content hashes of the cached rows
+    [
+        'ALTER TABLE skyhook_shows ADD COLUMN IF NOT EXISTS content_hash VARCHAR(40)',
+        'ALTER TABLE skyhook_seasons ADD COLUMN IF NOT EXISTS content_hash VARCHAR(40)',
+        'ALTER TABLE skyhook_episodes ADD COLUMN IF NOT EXISTS content_hash VARCHAR(40)',
+    ],
+    # 2: seasons and episodes reference their show by id instead of by title, indexes for every lookup
+    [
+        '''DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM information_schema.key_column_usage
+                       WHERE table_schema = current_schema() AND table_name = 'skyhook_shows'
+                       AND constraint_name = 'skyhook_shows_pkey' AND column_name = 'language') THEN
+                ALTER TABLE skyhook_shows DROP CONSTRAINT skyhook_shows_pkey;
+                ALTER TABLE skyhook_shows ADD PRIMARY KEY (id);
+            END IF;
+        END $$''',
+        'ALTER TABLE skyhook_shows ALTER COLUMN language SET NOT NULL',
+        'ALTER TABLE skyhook_seasons ADD COLUMN IF NOT EXISTS show_id INTEGER REFERENCES skyhook_shows (id)',
+        'ALTER TABLE skyhook_episodes ADD COLUMN IF NOT EXISTS show_id INTEGER REFERENCES skyhook_shows (id)',
+        # Shows sharing a title shared their seasons, those go to the first of them
+        '''UPDATE skyhook_seasons SET show_id = shows.id
+           FROM (SELECT title, min(id) AS id FROM skyhook_shows GROUP BY title) AS shows
+           WHERE shows.title = skyhook_seasons.show_title AND skyhook_seasons.show_id IS NULL''',
+        '''UPDATE skyhook_episodes SET show_id = skyhook_seasons.show_id
+           FROM skyhook_seasons
+           WHERE skyhook_seasons.id = skyhook_episodes.season_id AND skyhook_episodes.show_id IS NULL''',
+        'DELETE FROM skyhook_episodes WHERE show_id IS NULL',
+        'DELETE FROM skyhook_seasons WHERE show_id IS NULL',
+        'ALTER TABLE skyhook_seasons ALTER COLUMN show_id SET NOT NULL',
+        'ALTER TABLE skyhook_episodes ALTER COLUMN show_id SET NOT NULL',
+        'ALTER TABLE skyhook_seasons DROP CONSTRAINT IF EXISTS skyhook_seasons_show_title_number_key',
+        'CREATE UNIQUE INDEX IF NOT EXISTS skyhook_seasons_show_id_number_key ON skyhook_seasons (show_id, number)',
+        'CREATE INDEX IF NOT EXISTS ix_skyhook_episodes_show_id ON skyhook_episodes (show_id, season_number, number)',
+        'CREATE INDEX IF NOT EXISTS ix_skyhook_episodes_air_date_utc ON skyhook_episodes (air_date_utc)',
+        'CREATE INDEX IF NOT EXISTS ix_skyhook_shows_last_modified ON skyhook_shows (last_modified)',
+        'CREATE INDEX IF NOT EXISTS ix_skyhook_searches_search_string_language '
+        'ON skyhook_searches (search_string, language)',
+        # Shows left without seasons (the other shows of a shared title) are refetched on their next request
+        '''UPDATE skyhook_shows SET last_modified = '1970-01-01'
+           WHERE NOT EXISTS (SELECT 1 FROM skyhook_seasons WHERE skyhook_seasons.show_id = skyhook_shows.id)''',
+    ],
+    # 3: validators of the show documents, existing documents count as changed now
+    [
+        'ALTER TABLE skyhook_show_documents ADD COLUMN IF NOT EXISTS etag VARCHAR(40)',
+        'ALTER TABLE skyhook_show_documents ADD COLUMN IF NOT EXISTS changed TIMESTAMP',
+        "UPDATE skyhook_show_documents SET changed = timezone('UTC', now()) WHERE changed IS NULL",
+    ],
+    # 4: revisions for delta responses, everything stored so far is revision 0
+    [
+        'ALTER TABLE skyhook_shows ADD COLUMN IF NOT EXISTS revision INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE skyhook_seasons ADD COLUMN IF NOT EXISTS revision INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE skyhook_episodes ADD COLUMN IF NOT EXISTS revision INTEGER NOT NULL DEFAULT 0',
+        'CREATE INDEX IF NOT EXISTS ix_skyhook_episodes_show_id_revision ON skyhook_episodes (show_id, revision)',
+    ],
+    # 5: whether a show is streamed is decided when it is written, shows stored so far are decided on their next read
+    [
+        'ALTER TABLE skyhook_shows ADD COLUMN IF NOT EXISTS streamed BOOLEAN',
+    ],
+    # 6: deletions are only kept for the latest revisions of a show
+    [
+        'ALTER TABLE skyhook_shows ADD COLUMN IF NOT EXISTS delta_since INTEGER NOT NULL DEFAULT 0',
+    ],
+    # 7: one hash over all rows of a show, the validator of streamed shows
+    [
+        'ALTER TABLE skyhook_shows ADD COLUMN IF NOT EXISTS graph_hash VARCHAR(40)',
+    ],
+]
+
+
+def apply_migrations(connection):
+    # Returns the schema versions applied, connection has to be in a transaction
+    connection.execute(text('CREATE TABLE IF NOT EXISTS skyhook_schema_version (version INTEGER NOT NULL)'))
+    version = connection.execute(text('SELECT max(version) FROM skyhook_schema_version')).scalar() or 0
+    applied = []
+    for number, statements in enumerate(MIGRATIONS[version:], version + 1):
+        for statement in statements:
+            connection.execute(text(statement))
+        connection.execute(text('INSERT INTO skyhook_schema_version (version) VALUES (:version)'), version=number)
+        applied.append(number)
+    return applied
+
+
+def migrate():
+    from skyhook import db
+    from skyhook.coalesce import ADVISORY_LOCK_NAMESPACE
+    from skyhook.logger import Logger
+    with db.engine.begin() as connection:
+        # Every uwsgi worker migrates on start, let them take turns
+        connection.execute(text('SELECT pg_advisory_xact_lock(:namespace, 0)'), namespace=ADVISORY_LOCK_NAMESPACE)
+        for version in apply_migrations(connection):
+            Logger(__name__).info('Migrated database schema to version ' + str(version))
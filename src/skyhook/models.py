@@ -1,6 +1,7 @@
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import JSON, insert
 from skyhook import db
 from skyhook.logger import Logger
+from skyhook.streaming import iter_show_json
 import datetime
 
 logging = Logger(__name__)
@@ -15,6 +16,10 @@ class Search(db.Model):
     language = db.Column(db.String, nullable=True)
     results = db.Column(JSON, nullable=True)
 
+    __table_args__ = (
+        db.Index('ix_skyhook_searches_search_string_language', 'search_string', 'language'),
+    )
+
     def __init__(self, date, search_string, language, results):
         self.date = date
         self.search_string = search_string
@@ -22,13 +27,64 @@ class Search(db.Model):
         self.results = results
 
 
+class SeriesTitle(db.Model):
+    # Crosswalk of TVDB ID to series title per language, so shows we have seen before can be searched by ID without
+    # scraping TVDB or asking TV Maze for the title again.
+    __tablename__ = 'skyhook_series_titles'
+    # Language of the titles from TV Maze, its names are not localized
+    TVMAZE = 'tvmaze'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tvdb_id = db.Column(db.Integer)
+    language = db.Column(db.String)
+    title = db.Column(db.String)
+    date = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.UniqueConstraint('tvdb_id', 'language'),
+    )
+
+    def __repr__(self):
+        return '<SeriesTitle %r>' % self.title
+
+    @staticmethod
+    def lookup(tvdb_id, languages):
+        titles = dict(db.session.query(SeriesTitle.language, SeriesTitle.title).filter_by(tvdb_id=tvdb_id))
+        for language in list(languages) + [SeriesTitle.TVMAZE]:
+            if language in titles:
+                return titles[language]
+        return None
+
+    @staticmethod
+    def remember(titles):
+        # Committed on a connection of its own, whatever the caller's session has pending stays in its transaction
+        rows = {}
+        for tvdb_id, language, title in titles:
+            if title:
+                rows[(int(tvdb_id), language)] = {
+                    'tvdb_id': int(tvdb_id),
+                    'language': language,
+                    'title': title,
+                    'date': datetime.datetime.now()
+                }
+        if not rows:
+            return
+        statement = insert(SeriesTitle.__table__).values(list(rows.values()))
+        statement = statement.on_conflict_do_update(
+            index_elements=['tvdb_id', 'language'],
+            set_={'title': statement.excluded.title, 'date': statement.excluded.date}
+        )
+        with db.engine.begin() as connection:
+            connection.execute(statement)
+
+
 class Show(db.Model):
     __tablename__ = 'skyhook_shows'
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     last_modified = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     tvdb_id = db.Column(db.Integer)
-    language = db.Column(db.String, primary_key=True)
+    language = db.Column(db.String, nullable=False)
     title = db.Column(db.String)
     overview = db.Column(db.String)
     slug = db.Column(db.String)
@@ -46,21 +102,22 @@ class Show(db.Model):
     rating_value = db.Column(db.Float)
     rating_count = db.Column(db.Integer)
     images = db.Column(JSON)
-    seasons = db.relationship('Season',
-                              primaryjoin='Show.title == Season.show_title',
-                              foreign_keys='Season.show_title',
-                              backref='skyhook_shows',
-                              lazy='dynamic'
-                              )
-    episodes = db.relationship('Episode',
-                               primaryjoin='Show.title == Episode.show_title',
-                               foreign_keys='Episode.show_title',
-                               backref='skyhook_shows',
-                               lazy='dynamic'
-                               )
+    content_hash = db.Column(db.String(40))
+    # Moves up by one every time the show, a season or an episode changes, see Show.iter_sonarr_delta_json
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Set when the show is written, streamed shows have more than STREAM_SHOW_EPISODES episodes and no document.
+    # None for shows written before this was recorded.
+    streamed = db.Column(db.Boolean)
+    # Oldest revision a delta can start from, deletions up to it have been dropped
+    delta_since = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Hash of the content hashes of the show, its seasons and its episodes, set by update_show
+    graph_hash = db.Column(db.String(40))
+    seasons = db.relationship('Season', backref='skyhook_shows', lazy='dynamic')
+    episodes = db.relationship('Episode', backref='skyhook_shows', lazy='dynamic')
 
     __table_args__ = (
         db.UniqueConstraint('tvdb_id', 'language'),
+        db.Index('ix_skyhook_shows_last_modified', 'last_modified'),
     )
 
     def __init__(self, *initial_data, **kwargs):
@@ -73,7 +130,67 @@ class Show(db.Model):
     def __repr__(self):
         return '<Show %r>' % self.title
 
-    def to_sonarr_format(self):
+    def load_graph(self):
+        # Seasons and episodes for the whole show in two queries, see ShowGraph.
+        seasons = Season.query.filter_by(show_id=self.id).order_by(Season.number).all()
+        episodes = (Episode.query.filter_by(show_id=self.id)
+                    .order_by(Episode.season_number, Episode.number)
+                    .all()
+                    )
+        return ShowGraph(self, seasons, episodes)
+
+    def episode_count(self):
+        return Episode.query.filter_by(show_id=self.id).count()
+
+    def iter_sonarr_json(self, batch_size=500):
+        # The Sonarr document as chunks of JSON text. Episodes are read batch_size rows at a time and encoded one by
+        # one, so memory use doesn't grow with the number of episodes.
+        seasons = Season.query.filter_by(show_id=self.id).order_by(Season.number).all()
+        season_numbers = dict((season.id, season.number) for season in seasons)
+        episodes = (Episode.query.filter_by(show_id=self.id)
+                    .order_by(Episode.season_number, Episode.number)
+                    .yield_per(batch_size)
+                    )
+        header = self.to_sonarr_format(ShowGraph(self, [], []))
+        header.pop('seasons')
+        header.pop('episodes')
+        return iter_show_json(header,
+                              (season.to_sonarr_format() for season in seasons),
+                              (episode.to_sonarr_format(season_numbers[episode.season_id]) for episode in episodes))
+
+    def iter_sonarr_delta_json(self, since, batch_size=500):
+        # Like iter_sonarr_json, with only the seasons and episodes changed after revision `since`. Deleted seasons
+        # and episodes are listed separately, clients drop those before applying the changed ones.
+        seasons = Season.query.filter_by(show_id=self.id).order_by(Season.number).all()
+        season_numbers = dict((season.id, season.number) for season in seasons)
+        episodes = (Episode.query.filter_by(show_id=self.id)
+                    .filter(Episode.revision > since)
+                    .order_by(Episode.season_number, Episode.number)
+                    .yield_per(batch_size)
+                    )
+        deletions = Deletion.query.filter_by(show_id=self.id).filter(Deletion.revision > since).all()
+        header = self.to_sonarr_format(ShowGraph(self, [], []))
+        header.pop('seasons')
+        header.pop('episodes')
+        header['since'] = since
+        header['deletedSeasons'] = [deletion.season_number for deletion in deletions
+                                    if deletion.episode_number is None]
+        header['deletedEpisodes'] = [{'seasonNumber': deletion.season_number, 'episodeNumber': deletion.episode_number}
+                                     for deletion in deletions if deletion.episode_number is not None]
+        return iter_show_json(header,
+                              (season.to_sonarr_format() for season in seasons if season.revision > since),
+                              (episode.to_sonarr_format(season_numbers[episode.season_id]) for episode in episodes))
+
+    def to_sonarr_summary(self):
+        # The show and its seasons without episodes, as search results list them
+        seasons = Season.query.filter_by(show_id=self.id).order_by(Season.number).all()
+        sonarr_format = self.to_sonarr_format(ShowGraph(self, seasons, []))
+        sonarr_format.pop('episodes')
+        return sonarr_format
+
+    def to_sonarr_format(self, graph=None):
+        if graph is None:
+            graph = self.load_graph()
         sonarr_format = {
             'tvdbId': self.tvdb_id,
             'language': self.language,
@@ -98,6 +215,7 @@ class Show(db.Model):
                 'value': self.rating_value
             },
             'images': self.images,
+            'revision': self.revision,
             'seasons': [],
             'episodes': []
         }
@@ -108,43 +226,71 @@ class Show(db.Model):
         if self.images is None:
             sonarr_format.pop('images')
 
-        for season in self.seasons:
+        for season in graph.seasons:
             sonarr_format['seasons'].append(season.to_sonarr_format())
 
-        for episode in self.episodes:
-            sonarr_format['episodes'].append(episode.to_sonarr_format())
+        for episode in graph.episodes:
+            sonarr_format['episodes'].append(episode.to_sonarr_format(graph.season_numbers[episode.season_id]))
 
         return sonarr_format
 
+
+class ShowGraph(object):
+    # A show with all of its seasons and episodes preloaded, episodes are mapped to their season number in memory.
+    def __init__(self, show, seasons, episodes):
+        self.show = show
+        self.seasons = seasons
+        self.episodes = episodes
+        self.season_numbers = dict((season.id, season.number) for season in seasons)
+
     @staticmethod
-    def get_last_absolute_episode_number(show_title):
-        episode = (db.session.query(Episode)
-                   .filter(Episode.season_number != 0)
-                   .filter(Episode.absolute_number is not None)
-                   .filter_by(show_title=show_title)
-                   .order_by(Episode.absolute_number.desc()).first()
-                   )
-        #logging.debug(episode)
-        if episode is None or episode.absolute_number is None:
-            return 0
-        else:
-            return episode.absolute_number
+    def load(tvdb_id, language):
+        show = Show.query.filter_by(tvdb_id=tvdb_id, language=language).first()
+        if show is None:
+            return None
+        return show.load_graph()
+
+    def to_sonarr_format(self):
+        return self.show.to_sonarr_format(self)
+
+
+class ShowDocument(db.Model):
+    __tablename__ = 'skyhook_show_documents'
+
+    id = db.Column(db.Integer, primary_key=True)
+    tvdb_id = db.Column(db.Integer)
+    language = db.Column(db.String)
+    last_modified = db.Column(db.DateTime)
+    document = db.Column(db.LargeBinary)
+    etag = db.Column(db.String(40))
+    changed = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.UniqueConstraint('tvdb_id', 'language'),
+    )
+
+    def __repr__(self):
+        return '<ShowDocument %r>' % self.tvdb_id
 
 
 class Season(db.Model):
     __tablename__ = 'skyhook_seasons'
 
     id = db.Column(db.Integer, primary_key=True)
+    show_id = db.Column(db.Integer, db.ForeignKey('skyhook_shows.id'), nullable=False)
     show_title = db.Column(db.String)
     number = db.Column(db.Integer)
     images = db.Column(JSON)
+    content_hash = db.Column(db.String(40))
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     episodes = db.relationship('Episode', backref='skyhook_seasons')
 
     __table_args__ = (
-        db.UniqueConstraint('show_title', 'number'),
+        db.UniqueConstraint('show_id', 'number', name='skyhook_seasons_show_id_number_key'),
     )
 
-    def __init__(self, show_title, number, images):
+    def __init__(self, show_id, show_title, number, images):
+        self.show_id = show_id
         self.show_title = show_title
         self.number = number
         self.images = images
@@ -173,6 +319,7 @@ class Episode(db.Model):
     __tablename__ = 'skyhook_episodes'
 
     id = db.Column(db.Integer, primary_key=True)
+    show_id = db.Column(db.Integer, db.ForeignKey('skyhook_shows.id'), nullable=False)
     show_title = db.Column(db.String)
     tvdb_show_id = db.Column(db.Integer)
     tvdb_id = db.Column(db.Integer)
@@ -189,17 +336,26 @@ class Episode(db.Model):
     writers = db.Column(JSON)
     directors = db.Column(JSON)
     image = db.Column(db.String)
+    content_hash = db.Column(db.String(40))
+    revision = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
-    __table_args__ = (db.UniqueConstraint('season_id', 'number'),)
+    __table_args__ = (
+        db.UniqueConstraint('season_id', 'number'),
+        db.Index('ix_skyhook_episodes_show_id', 'show_id', 'season_number', 'number'),
+        db.Index('ix_skyhook_episodes_air_date_utc', 'air_date_utc'),
+        db.Index('ix_skyhook_episodes_show_id_revision', 'show_id', 'revision'),
+    )
 
-    def __init__(self, show_title, tvdb_show_id, tvdb_id, season_id, number,
+    def __init__(self, show_id, show_title, tvdb_show_id, tvdb_id, season_id, season_number, number,
                  absolute_number, title, air_date, air_date_utc, rating_value,
                  rating_count, overview, writers, directors, image
                  ):
+        self.show_id = show_id
         self.show_title = show_title
         self.tvdb_show_id = tvdb_show_id
         self.tvdb_id = tvdb_id
         self.season_id = season_id
+        self.season_number = season_number
         self.number = number
         self.absolute_number = absolute_number
         self.title = title
@@ -212,31 +368,19 @@ class Episode(db.Model):
         self.directors = directors
         self.image = image
 
-        # Dirty trick to set the absolute episode number
-        # FIXME
-        season = self.get_season()
-        self.season_number = season.number
-        #logging.debug('Season number: ' + str(season.number))
-        if self.absolute_number is None:
-            if int(season.number) > 0:
-                self.absolute_number = Show.get_last_absolute_episode_number(show_title=show_title)
-                self.absolute_number += 1
-
-        if int(season.number) > 0 and self.absolute_number is None:
-            logging.error('Absolute number is None for show "' + self.show_title + '": season ' + str(self.get_season().number) + ' episode ' + str(self.number))
-
     def __repr__(self):
         return '<Episode %r>' % self.title
 
     def get_season(self):
         return Season.query.get(self.season_id)
 
-    def to_sonarr_format(self):
-        season = self.get_season()
+    def to_sonarr_format(self, season_number=None):
+        if season_number is None:
+            season_number = self.get_season().number
         sonarr_format = {
             'tvdbShowId': self.tvdb_show_id,
             'tvdbId': self.tvdb_id,
-            'seasonNumber': season.number,
+            'seasonNumber': season_number,
             'episodeNumber': self.number,
             'absoluteEpisodeNumber': self.absolute_number,
             'title': self.title,
@@ -251,7 +395,7 @@ class Episode(db.Model):
             'directors': self.directors,
             'image': self.image
         }
-        if int(season.number) == 0:
+        if int(season_number) == 0:
             sonarr_format.pop('seasonNumber')
 
         if self.writers is None:
@@ -263,3 +407,21 @@ class Episode(db.Model):
         if self.image is None:
             sonarr_format.pop('image')
         return sonarr_format
+
+
+class Deletion(db.Model):
+    # A season (episode_number None) or an episode removed from a show at a revision, for delta responses
+    __tablename__ = 'skyhook_deletions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    show_id = db.Column(db.Integer, nullable=False)
+    revision = db.Column(db.Integer, nullable=False)
+    season_number = db.Column(db.Integer)
+    episode_number = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_skyhook_deletions_show_id_revision', 'show_id', 'revision'),
+    )
+
+    def __repr__(self):
+        return '<Deletion %r>' % self.show_id
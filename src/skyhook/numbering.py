@@ -0,0 +1,38 @@
+def episode_sort_key(episode):
+    # Episodes without a number (common for daily shows) are ordered by air date within their season.
+    season = episode['seasonNumber'] if 'seasonNumber' in episode else 0
+    number = episode['episodeNumber'] if 'episodeNumber' in episode else None
+    air_date = episode['airDate'] if 'airDate' in episode and episode['airDate'] is not None else ''
+    return (
+        season,
+        number is None,
+        number if number is not None else 0,
+        air_date
+    )
+
+
+def assign_absolute_numbers(episodes):
+    # Fills in missing absoluteEpisodeNumber values for a whole show in memory, walking the episodes in
+    # (season, episode) order. Numbers that TVDB already provides (anime) are kept and never handed out twice,
+    # specials (season 0) are left without an absolute number. Returns the episodes in (season, episode) order.
+    episodes = sorted(episodes, key=episode_sort_key)
+    taken = set()
+    for episode in episodes:
+        if episode.get('absoluteEpisodeNumber') is not None:
+            episode['absoluteEpisodeNumber'] = int(episode['absoluteEpisodeNumber'])
+            taken.add(episode['absoluteEpisodeNumber'])
+
+    last_absolute_number = 0
+    for episode in episodes:
+        season = episode['seasonNumber'] if 'seasonNumber' in episode else 0
+        if season <= 0:
+            continue
+        absolute_number = episode.get('absoluteEpisodeNumber')
+        if absolute_number is None:
+            absolute_number = last_absolute_number + 1
+            while absolute_number in taken:
+                absolute_number += 1
+            taken.add(absolute_number)
+            episode['absoluteEpisodeNumber'] = absolute_number
+        last_absolute_number = max(last_absolute_number, absolute_number)
+    return episodes
@@ -0,0 +1,98 @@
+import datetime
+import threading
+import time
+
+import pytz
+from skyhook import app, db
+from skyhook.logger import Logger
+from skyhook.models import Episode, Show
+from sqlalchemy import func, or_
+
+logging = Logger(__name__)
+# A show without a status counts as continuing, status <> 'Ended' alone leaves out NULL
+CONTINUING = or_(Show.status.is_(None), Show.status != 'Ended')
+
+
+class Prewarmer(object):
+    # Refreshes shows before clients ask for them, at most `budget` refreshes every `interval` seconds:
+    #   1. continuing shows with an episode airing within PREWARM_LEAD_TIME that weren't refreshed since
+    #   2. continuing shows past SHOW_CACHE_TIME, oldest first
+    #   3. ended shows, only once they are older than PREWARM_ENDED_INTERVAL
+    def __init__(self, refresher, interval, budget):
+        self.refresher = refresher
+        self.interval = interval
+        self.budget = budget
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='skyhook-prewarm')
+            self.thread.daemon = True
+            self.thread.start()
+        logging.info('Started prewarming every ' + str(self.interval) + ' seconds')
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with app.app_context():
+                    self.prewarm()
+            except Exception as e:
+                logging.error('Prewarming failed: ' + str(e))
+            finally:
+                db.session.remove()
+
+    def prewarm(self):
+        scheduled = 0
+        for tvdb_id in self.due_shows():
+            if scheduled >= self.budget:
+                break
+            if self.refresher.schedule(str(tvdb_id)):
+                scheduled += 1
+        logging.debug('Prewarming scheduled ' + str(scheduled) + ' show refreshes')
+        return scheduled
+
+    def due_shows(self):
+        now = datetime.datetime.now()
+        now_utc = datetime.datetime.now(pytz.utc)
+        lead_time = datetime.timedelta(seconds=app.config['PREWARM_LEAD_TIME'])
+        due = []
+
+        upcoming = (db.session.query(Show.tvdb_id, Show.last_modified, func.min(Episode.air_date_utc))
+                    .join(Episode, Episode.show_id == Show.id)
+                    .filter(CONTINUING)
+                    .filter(Episode.air_date_utc > now_utc)
+                    .filter(Episode.air_date_utc <= now_utc + lead_time)
+                    .group_by(Show.tvdb_id, Show.last_modified)
+                    .order_by(func.min(Episode.air_date_utc))
+                    )
+        for tvdb_id, last_modified, air_date_utc in upcoming:
+            # last_modified is local time, air dates are UTC
+            if last_modified < now + (air_date_utc - now_utc) - lead_time:
+                due.append(tvdb_id)
+
+        stale = (db.session.query(Show.tvdb_id)
+                 .filter(CONTINUING)
+                 .filter(Show.last_modified < now - datetime.timedelta(seconds=app.config['SHOW_CACHE_TIME']))
+                 .order_by(Show.last_modified)
+                 .limit(self.budget)
+                 )
+        due.extend(tvdb_id for tvdb_id, in stale)
+
+        ended = (db.session.query(Show.tvdb_id)
+                 .filter(Show.status == 'Ended')
+                 .filter(Show.last_modified < now - datetime.timedelta(seconds=app.config['PREWARM_ENDED_INTERVAL']))
+                 .order_by(Show.last_modified)
+                 .limit(self.budget)
+                 )
+        due.extend(tvdb_id for tvdb_id, in ended)
+
+        # A show can be due for more than one reason (and in more than one language), keep its first position
+        unique_due = []
+        for tvdb_id in due:
+            if tvdb_id not in unique_due:
+                unique_due.append(tvdb_id)
+        return unique_due
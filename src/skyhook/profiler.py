@@ -0,0 +1,104 @@
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return os.path.basename(code.co_filename) + ':' + code.co_name
+
+
+def collapse(frame):
+    # Outermost call first, as flamegraph.pl and speedscope expect
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler(object):
+    # Samples the stack of one thread (or of every thread) every interval seconds from a thread of its own, so the
+    # profiled code runs unmodified. Stacks are counted in the collapsed format, a "frame;frame;frame count" line each.
+    def __init__(self, interval, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id
+        self.stacks = Counter()
+        self.samples = 0
+        self.running = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self.run, name='skyhook-profiler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+        while self.running.is_set():
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frames = {self.thread_id: frames.get(self.thread_id)}
+            for thread_id, frame in frames.items():
+                if frame is None or thread_id == own_id:
+                    continue
+                stack = collapse(frame)
+                if self.thread_id is None:
+                    if thread_id not in names:
+                        names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+                    stack = names.get(thread_id, str(thread_id)) + ';' + stack
+                self.stacks[stack] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def collapsed(self):
+        return ''.join(stack + ' ' + str(count) + '\n' for stack, count in self.stacks.most_common())
+
+
+class RequestProfile(object):
+    # Everything recorded while profiling one request: its stack samples, the SQL statements it ran and the tags
+    # (route, tvdb_id, cache outcome, ...) it is written out with.
+    def __init__(self, interval, all_threads=False):
+        self.profiler = SamplingProfiler(interval, None if all_threads else threading.get_ident())
+        self.queries = []
+        self.tags = {}
+        self.started = None
+
+    def start(self):
+        self.started = time.time()
+        self.profiler.start()
+
+    def stop(self):
+        self.profiler.stop()
+        self.tags['duration'] = round(time.time() - self.started, 6)
+        self.tags['samples'] = self.profiler.samples
+
+    def record_query(self, statement, parameters, duration):
+        self.queries.append({'statement': statement, 'parameters': repr(parameters)[:500],
+                             'duration': round(duration, 6)})
+
+    def write(self, directory):
+        # <time>-<route>-<tvdb_id>.collapsed for flamegraph tools, and a .json with the tags and the SQL statements
+        # next to it. Returns the path both share.
+        os.makedirs(directory, exist_ok=True)
+        name = '-'.join([time.strftime('%Y%m%dT%H%M%S', time.gmtime(self.started)),
+                         '%06d' % int(self.started % 1 * 1000000),
+                         re.sub(r'[^A-Za-z0-9_.]+', '_', str(self.tags.get('route', 'unknown'))).strip('_'),
+                         str(self.tags.get('tvdb_id') or 'none')])
+        path = os.path.join(directory, name)
+        with open(path + '.collapsed', 'w') as f:
+            f.write(self.profiler.collapsed())
+        with open(path + '.json', 'w') as f:
+            json.dump({'tags': self.tags, 'queries': self.queries}, f, indent=2, default=str)
+        return path
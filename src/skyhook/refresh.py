@@ -0,0 +1,40 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from skyhook import app, db
+from skyhook.logger import Logger
+
+logging = Logger(__name__)
+
+
+class Refresher(object):
+    # Runs refreshes on background workers. A key that is already queued or running is not queued again,
+    # so any number of requests for the same stale show lead to a single refresh.
+    def __init__(self, refresh, workers):
+        self.refresh = refresh
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def schedule(self, key):
+        with self.lock:
+            if key in self.pending:
+                return False
+            self.pending.add(key)
+        self.executor.submit(self.run, key)
+        return True
+
+    def is_pending(self, key):
+        with self.lock:
+            return key in self.pending
+
+    def run(self, key):
+        try:
+            with app.app_context():
+                self.refresh(key)
+        except Exception as e:
+            logging.error('Background refresh of "' + str(key) + '" failed: ' + str(e))
+        finally:
+            db.session.remove()
+            with self.lock:
+                self.pending.discard(key)
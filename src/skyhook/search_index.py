@@ -0,0 +1,136 @@
+import bisect
+import re
+import threading
+from collections import Counter, namedtuple
+
+WORD = re.compile(r'\w+', re.UNICODE)
+ARTICLES = ('the', 'a', 'an')
+# Highest score of a query whose only word is a prefix ("hous"), kept under the score that answers a search without
+# asking TVDB, so shows that aren't cached yet can still be found by a partial title
+PREFIX_ONLY_SCORE = 0.75
+
+IndexEntry = namedtuple('IndexEntry', ['title', 'slug', 'tokens', 'trigrams'])
+
+
+def normalize(text):
+    # "The Office (US)", "the-office-us" and "office us" all become "office us"
+    words = WORD.findall(text.lower().replace('_', ' '))
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return ' '.join(words)
+
+
+def trigrams(text):
+    padded = ' ' + text + ' '
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class SearchIndex(object):
+    # In-memory title index over cached shows. Keys are opaque (SonarrCache uses (tvdb_id, language)), a query is
+    # matched on its normalized form, on tokens with the last one as a prefix ("office u") and on trigram
+    # similarity for typos. Scores run from 0 to 1, 1 being an exact title or slug match.
+    def __init__(self):
+        self.entries = {}
+        self.token_keys = {}
+        self.trigram_keys = {}
+        self.sorted_tokens = []
+        self.sorted_tokens_dirty = False
+        self.synced = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def add(self, key, title, slug=None):
+        title = normalize(title or '')
+        if not title:
+            return
+        entry = IndexEntry(title, normalize(slug or '') or None, frozenset(title.split()), trigrams(title))
+        with self.lock:
+            if self.entries.get(key) == entry:
+                return
+            self.unlink(key)
+            self.entries[key] = entry
+            for token in entry.tokens:
+                if token not in self.token_keys:
+                    self.token_keys[token] = set()
+                    self.sorted_tokens_dirty = True
+                self.token_keys[token].add(key)
+            for trigram in entry.trigrams:
+                self.trigram_keys.setdefault(trigram, set()).add(key)
+
+    def remove(self, key):
+        with self.lock:
+            self.unlink(key)
+
+    def unlink(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        for token in entry.tokens:
+            keys = self.token_keys[token]
+            keys.discard(key)
+            if not keys:
+                del self.token_keys[token]
+                self.sorted_tokens_dirty = True
+        for trigram in entry.trigrams:
+            keys = self.trigram_keys[trigram]
+            keys.discard(key)
+            if not keys:
+                del self.trigram_keys[trigram]
+
+    def prefixed_tokens(self, prefix):
+        if self.sorted_tokens_dirty:
+            self.sorted_tokens = sorted(self.token_keys)
+            self.sorted_tokens_dirty = False
+        position = bisect.bisect_left(self.sorted_tokens, prefix)
+        while position < len(self.sorted_tokens) and self.sorted_tokens[position].startswith(prefix):
+            yield self.sorted_tokens[position]
+            position += 1
+
+    def search(self, query, min_score, limit=10):
+        # Returns [(score, key)] best first, only matches scoring at least min_score
+        query = normalize(query)
+        if not query:
+            return []
+        tokens = query.split()
+        query_trigrams = trigrams(query)
+        with self.lock:
+            candidates = set()
+            for token in tokens[:-1]:
+                candidates.update(self.token_keys.get(token, ()))
+            for token in self.prefixed_tokens(tokens[-1]):
+                candidates.update(self.token_keys[token])
+
+            shared_trigrams = Counter()
+            for trigram in query_trigrams:
+                shared_trigrams.update(self.trigram_keys.get(trigram, ()))
+            candidates.update(shared_trigrams)
+
+            matches = []
+            for key in candidates:
+                entry = self.entries[key]
+                shared = shared_trigrams[key]
+                similarity = float(shared) / (len(query_trigrams) + len(entry.trigrams) - shared)
+                score = max(self.score(query, tokens, entry), similarity)
+                if score >= min_score:
+                    matches.append((score, key))
+        matches.sort(key=lambda match: -match[0])
+        return matches[:limit]
+
+    @staticmethod
+    def score(query, tokens, entry):
+        if query == entry.title or query == entry.slug:
+            return 1.0
+        if not all(token in entry.tokens for token in tokens[:-1]):
+            return 0.0
+        prefixed = [token for token in entry.tokens if token.startswith(tokens[-1])]
+        if not prefixed:
+            return 0.0
+        # Every query token is in the title, score by how much of the title the query covers. The last token may
+        # still be typed, it counts for the part of the word it covers.
+        covered = len(tokens) - 1 + float(len(tokens[-1])) / min(len(token) for token in prefixed)
+        score = min(0.95, 0.5 + 0.5 * covered / len(entry.tokens))
+        if len(tokens) == 1 and tokens[0] not in entry.tokens:
+            return min(PREFIX_ONLY_SCORE, score)
+        return score
@@ -0,0 +1,24 @@
+import json
+
+
+def iter_json_array(items):
+    # JSON text of a list, one item at a time
+    yield '['
+    separator = ''
+    for item in items:
+        yield separator + json.dumps(item)
+        separator = ', '
+    yield ']'
+
+
+def iter_show_json(header, seasons, episodes):
+    # JSON text of a Sonarr show: the show fields (header, without seasons and episodes) first, then the seasons and
+    # the episodes, encoded one at a time as the iterables produce them.
+    text = json.dumps(header)
+    yield text[:-1] + (', ' if header else '') + '"seasons": '
+    for chunk in iter_json_array(seasons):
+        yield chunk
+    yield ', "episodes": '
+    for chunk in iter_json_array(episodes):
+        yield chunk
+    yield '}'
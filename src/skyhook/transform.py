@@ -0,0 +1,71 @@
+import datetime
+import re
+
+import dateutil.parser
+import pytz
+
+AIR_TIME = re.compile(r'^\s*(\d{1,2})(?:[:.](\d{2}))?\s*(?:([AaPp])\.?\s*[Mm]\.?)?\s*$')
+UTC_FORMAT = '%04d-%02d-%02dT%02d:%02d:%02dZ'
+
+
+def parse_air_time(value):
+    # (hours, minutes) from TVDB's free-form Airs_Time ("8:00 PM", "20:00", "9pm"), None when it isn't set
+    if value is None:
+        return None
+    match = AIR_TIME.match(value)
+    if match is None:
+        parsed = dateutil.parser.parse(value)
+        return parsed.hour, parsed.minute
+    hours = int(match.group(1))
+    minutes = int(match.group(2)) if match.group(2) is not None else 0
+    meridiem = match.group(3)
+    if meridiem is not None:
+        hours = hours % 12 + (12 if meridiem in 'Pp' else 0)
+    if hours > 23 or minutes > 59:
+        parsed = dateutil.parser.parse(value)
+        return parsed.hour, parsed.minute
+    return hours, minutes
+
+
+def parse_date(value):
+    # TVDB dates are YYYY-MM-DD, anything else goes through dateutil
+    if len(value) == 10 and value[4] == '-' and value[7] == '-':
+        try:
+            return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]))
+        except ValueError:
+            pass
+    return dateutil.parser.parse(value)
+
+
+class EpisodeTransformer(object):
+    # Computes airDateUtc for every episode of a show in one pass. Timezones are looked up once per language and
+    # kept, zones without daylight saving time are converted with their fixed offset.
+    def __init__(self, timezone_names, default_timezone):
+        self.timezone_names = timezone_names
+        self.default_timezone = default_timezone
+        self.timezones = {}
+
+    def get_timezone(self, language):
+        timezone = self.timezones.get(language)
+        if timezone is None:
+            timezone = pytz.timezone(self.timezone_names.get(language, self.default_timezone))
+            self.timezones[language] = timezone
+        return timezone
+
+    @staticmethod
+    def to_utc(timezone, date):
+        if isinstance(timezone, pytz.tzinfo.StaticTzInfo) or timezone is pytz.utc:
+            return date - timezone.utcoffset(date)
+        return date - timezone.localize(date).utcoffset()
+
+    def set_air_dates_utc(self, episodes, languages, time_of_day):
+        # episodes are Sonarr episodes with an airDate, languages holds the TVDB language of each episode
+        if time_of_day is None:
+            return episodes
+        air_time = datetime.timedelta(hours=time_of_day[0], minutes=time_of_day[1])
+        for episode, language in zip(episodes, languages):
+            if episode['airDate'] is None:
+                continue
+            date = self.to_utc(self.get_timezone(language), parse_date(episode['airDate']) + air_time)
+            episode['airDateUtc'] = UTC_FORMAT % (date.year, date.month, date.day, date.hour, date.minute, date.second)
+        return episodes
@@ -1,13 +1,16 @@
-import datetime
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed, wait
 from enum import Enum
-import pytz
-import dateutil.parser
-import requests
+import aiohttp
 import tvdb_api
-import pytvmaze
 from lxml import html
+from skyhook.aio import PreloadedTvdb
 from skyhook.logger import Logger
-from skyhook.models import Show
+from skyhook.metrics import stage_latency
+from skyhook.models import SeriesTitle, Show
+from skyhook.transform import EpisodeTransformer, parse_air_time
+from urllib.parse import quote as url_quote
 
 logging = Logger(__name__)
 
@@ -64,15 +67,26 @@ class LanguageTimezone(Enum):
     ko = 'Asia/Seoul'
 
 
+episode_transformer = EpisodeTransformer(dict((language.name, language.value) for language in LanguageTimezone), 'EST')
+
+
 class TvDB:
-    def __init__(self, api_key):
+    def __init__(self, api_key, upstream, aio):
+        from skyhook import app
+        self.api_key = api_key
+        self.upstream = upstream
+        self.aio = aio
+        self.language_clients = {}
+        self.language_clients_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=app.config['UPSTREAM_WORKERS'])
         self.tvdb = tvdb_api.Tvdb(
             apikey=api_key,
             actors=True,
             banners=True,
             search_all_languages=False,
             select_first=False,
-            cache=True,
+            # Without a session of its own tvdb_api would open an on-disk cache
+            cache=self.upstream.session,
             language=None,
             useZip=False
         )
@@ -84,11 +98,19 @@ class TvDB:
             banners=True,
             search_all_languages=False,
             select_first=False,
-            cache=True,
+            cache=self.upstream.session,
             language=language,
             useZip=False
         )
 
+    def get_language_client(self, language):
+        # One client per language so searches in different languages can run at the same time without
+        # overriding each other's configured language.
+        with self.language_clients_lock:
+            if language not in self.language_clients:
+                self.language_clients[language] = self.get_tvdb(self.api_key, language)
+            return self.language_clients[language]
+
     @staticmethod
     def get_language(abbreviation):
         return Language[abbreviation]
@@ -96,83 +118,187 @@ class TvDB:
     def get_show(self, tvdb_id):
         return self.tvdb.search(tvdb_id)
 
+    @stage_latency.time(stage='tvdb_search')
     def search(self, string, language, tvdb_id=None):
         # TODO: Language
         from skyhook import app
         search_results = None
         if tvdb_id is not None:
-            # Get the show name by parsing the HTML DOM.
-            # The TVDB API does not provide a method to grab the show by ID.
-            # http://thetvdb.com/?tab=series&id=299964&lid=9
-            for language in app.config['TVDB_LANGUAGES']:
-                lid = self.tvdb.config['langabbv_to_id'][language]
-                r = requests.get('http://thetvdb.com/?tab=series&id=' + str(tvdb_id) + '&lid=' + str(lid))
-                if r.status_code != 200:
-                    continue
-                tree = html.fromstring(r.content)
-                title = tree.findtext('.//title')
-                title = title.replace(': Series Info', '')
-                if title == '':
-                    # Show not found, continue
-                    continue
-                string = title
-                break
+            with stage_latency.time(stage='resolve_title'):
+                string = self.resolve_title(tvdb_id)
             if string is None:
-                # Fallback to TV MAZE
-                try:
-                    # Try to grab the series name from Maze TV via TVDB ID.
-                    tvmaze = self.get_tvmaze(tvdb_id)
-                    string = tvmaze.name
-                except pytvmaze.ShowNotFound:
-                    logging.debug('TVMaze Show not found with TVDB ID: ' + tvdb_id)
-                    return None
+                logging.debug('Unable to find a title for TVDB ID: ' + str(tvdb_id))
+                return None
+        # Search every configured language at once, slow languages are dropped after TVDB_SEARCH_TIMEOUT seconds
+        searches = []
         for language in app.config['TVDB_LANGUAGES']:
-            logging.debug('Searching TVDB for ' +
-                          ('ID=' + tvdb_id if tvdb_id is not None else 'NAME="' + string + '"') +
-                          ' and language "' + language + '"')
-            # Override from the TVDB API
-            self.tvdb.config['language'] = language
-            self.tvdb.config[
-                'url_getSeries'] = u"%(base_url)s/api/GetSeries.php?seriesname=%%s&language=%(language)s" % self.tvdb.config
-            results = self.tvdb.search(string)
-            if results is not None:
-                # Loop through the results and only match the exact search string / tvdb id
-                for result in results:
-                    if language != result['language']:
-                        continue
-                    if tvdb_id is not None and str(tvdb_id) == str(result['id']):
-                        # Only return 1 result if we are searching with tv db id's
-                        return [result]
-                    elif result['seriesname'].lower() == string.lower():
-                        if search_results is None:
-                            search_results = []
-                        # Append the show to the search results
-                        search_results.append(result)
+            searches.append((language, self.executor.submit(self.search_language, string, language, tvdb_id)))
+        done, not_done = wait([future for language, future in searches], timeout=app.config['TVDB_SEARCH_TIMEOUT'])
+
+        # Merge in configured language order
+        for language, future in searches:
+            if future in not_done:
+                future.cancel()
+                logging.warning('Searching TVDB for language "' + language + '" timed out')
+                continue
+            try:
+                id_match, results = future.result()
+            except Exception as e:
+                logging.warning('Searching TVDB for language "' + language + '" failed: ' + str(e))
+                continue
+            if id_match is not None:
+                # Only return 1 result if we are searching with tv db id's
+                return [id_match]
+            if results:
+                if search_results is None:
+                    search_results = []
+                # Append the shows to the search results
+                search_results.extend(results)
         return search_results
 
+    def search_language(self, string, language, tvdb_id=None):
+        logging.debug('Searching TVDB for ' +
+                      ('ID=' + str(tvdb_id) if tvdb_id is not None else 'NAME="' + string + '"') +
+                      ' and language "' + language + '"')
+        id_match = None
+        search_results = []
+        results = self.aio.run(self.search_series_async(string, language))
+        if results is not None:
+            # Loop through the results and only match the exact search string / tvdb id
+            for result in results:
+                if language != result['language']:
+                    continue
+                if tvdb_id is not None and str(tvdb_id) == str(result['id']):
+                    id_match = result
+                    break
+                elif result['seriesname'].lower() == string.lower():
+                    search_results.append(result)
+        return id_match, search_results
+
+    def resolve_title(self, tvdb_id):
+        # The TVDB API does not provide a method to grab the show by ID, so race the series page of every configured
+        # language against TV Maze and take the first title that comes back.
+        from skyhook import app
+        title = SeriesTitle.lookup(tvdb_id, app.config['TVDB_LANGUAGES'])
+        if title is not None:
+            logging.debug('Found title "' + title + '" for TVDB ID ' + str(tvdb_id) + ' in the title crosswalk')
+            return title
+
+        lookups = {}
+        for language in app.config['TVDB_LANGUAGES']:
+            lookups[self.executor.submit(self.scrape_title, tvdb_id, language)] = language
+        # TV Maze names are not localized, they are kept apart and only used when no language has a title
+        lookups[self.executor.submit(self.get_tvmaze_title, tvdb_id)] = SeriesTitle.TVMAZE
+        try:
+            for future in as_completed(lookups, timeout=app.config['TVDB_RESOLVE_TIMEOUT']):
+                try:
+                    title = future.result()
+                except Exception as e:
+                    logging.warning('Title lookup for TVDB ID ' + str(tvdb_id) + ' failed: ' + str(e))
+                    continue
+                if title is not None:
+                    SeriesTitle.remember([(tvdb_id, lookups[future], title)])
+                    return title
+        except TimeoutError:
+            logging.warning('Title lookup for TVDB ID ' + str(tvdb_id) + ' timed out')
+        finally:
+            for future in lookups:
+                future.cancel()
+        return None
+
+    def scrape_title(self, tvdb_id, language):
+        # Get the show name by parsing the HTML DOM.
+        # http://thetvdb.com/?tab=series&id=299964&lid=9
+        from skyhook import app
+        lid = self.tvdb.config['langabbv_to_id'][language]
+        r = self.upstream.get('http://thetvdb.com/?tab=series&id=' + str(tvdb_id) + '&lid=' + str(lid),
+                              timeout=(app.config['UPSTREAM_CONNECT_TIMEOUT'], app.config['TVDB_SCRAPE_TIMEOUT']))
+        if r.status_code != 200:
+            return None
+        tree = html.fromstring(r.content)
+        title = tree.findtext('.//title')
+        if title is None:
+            return None
+        title = title.replace(': Series Info', '')
+        if title == '':
+            # Show not found
+            return None
+        return title
+
+    def get_tvmaze_title(self, tvdb_id):
+        # Try to grab the series name from Maze TV via TVDB ID.
+        tvmaze = self.get_tvmaze(tvdb_id)
+        if tvmaze is None:
+            logging.debug('TVMaze Show not found with TVDB ID: ' + str(tvdb_id))
+            return None
+        return tvmaze.name
+
     def get_tvmaze(self, tvdb_id):
-        return pytvmaze.get_show(tvdb_id=tvdb_id)
+        return self.upstream.get_tvmaze_show(tvdb_id)
+
+    async def search_series_async(self, string, language):
+        # GetSeries for one language, parsed by tvdb_api like a regular search
+        client = self.get_language_client(language)
+        url = client.config['url_getSeries'] % url_quote(string.encode('utf-8'))
+        status, body = await self.aio.get(url)
+        return PreloadedTvdb({url: body}, apikey=self.api_key, language=language).search(string)
+
+    async def get_series_async(self, tvdb_id):
+        # Series info, episodes, banners and actors are downloaded at once, then parsed into the same show object
+        # self.tvdb[tvdb_id] would return. Parsing big shows takes a while, so it runs off the event loop.
+        language = self.tvdb.config['language']
+        config = self.tvdb.config
+        responses = await self.aio.get_many([
+            config['url_seriesInfo'] % (tvdb_id, language),
+            config['url_epInfo'] % (tvdb_id, language),
+            config['url_seriesBanner'] % tvdb_id,
+            config['url_actorsInfo'] % tvdb_id
+        ])
+        client = PreloadedTvdb(responses, apikey=self.api_key, actors=True, banners=True, language=language)
+        return await asyncio.get_event_loop().run_in_executor(None, client.__getitem__, int(tvdb_id))
+
+    async def get_tvmaze_async(self, tvdb_id):
+        try:
+            return await self.aio.get_tvmaze_show(tvdb_id)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warning('TVMaze lookup failed for ' + str(tvdb_id) + ': ' + str(e))
+            return None
+
+    async def get_show_async(self, result):
+        show, tvmaze = await asyncio.gather(self.get_series_async(result['id']), self.get_tvmaze_async(result['id']))
+        return show, tvmaze
+
+    async def get_shows_async(self, results):
+        return await asyncio.gather(*[self.get_show_async(result) for result in results])
 
     def to_sonarr_format(self, result):
-        show = self.tvdb[result['id']]
+        with stage_latency.time(stage='tvdb_fetch'):
+            show, tvmaze = self.aio.run(self.get_show_async(result))
+        with stage_latency.time(stage='transform'):
+            return self.build_sonarr_format(result, show, tvmaze)
+
+    def to_sonarr_formats(self, results):
+        # Fetches every result concurrently
+        with stage_latency.time(stage='tvdb_fetch'):
+            shows = self.aio.run(self.get_shows_async(results))
+        with stage_latency.time(stage='transform'):
+            return [self.build_sonarr_format(result, show, tvmaze) for result, (show, tvmaze) in zip(results, shows)]
+
+    def build_sonarr_format(self, result, show, tvmaze):
         original_show = show
         tvmaze_id = None
         tvrage_id = None
-        try:
-            tvmaze = self.get_tvmaze(result['id'])
+        if tvmaze is not None:
             tvmaze_id = tvmaze.id
             if 'tvrage' in tvmaze.externals:
                 tvrage_id = tvmaze.externals['tvrage']
-        except pytvmaze.ShowNotFound:
+        else:
             logging.info('TVMaze Show not found: ' + str(result['id']))
-            pass
-        except pytvmaze.IDNotFound:
-            logging.info('TVMaze ID not found: ' + str(result['id']))
-            pass
         if show['seriesname'] is None:
             if show.data is None:
                 raise Exception('Missing series')
             show = show.data
+        time_of_day = parse_air_time(show['airs_time'])
         sonarr_format = {
             'tvdbId': result['id'],
             'title': result['seriesname'],
@@ -186,8 +312,8 @@ class TvDB:
             'status': show['status'],
             'runtime': show['runtime'],
             'timeOfDay': {
-                'hours': dateutil.parser.parse(show['airs_time']).hour if show['airs_time'] is not None else None,
-                'minutes': dateutil.parser.parse(show['airs_time']).minute if show['airs_time'] is not None else None
+                'hours': time_of_day[0] if time_of_day is not None else None,
+                'minutes': time_of_day[1] if time_of_day is not None else None
             },
             'network': result['network'] if 'network' in result else None,
             'imdbId': show['imdb_id'],
@@ -212,6 +338,7 @@ class TvDB:
 
         # Episodes
         episode_seasons = []
+        episode_languages = []
         sonarr_episodes = []
         for season in original_show.values():
             for episode in season.values():
@@ -232,20 +359,7 @@ class TvDB:
                     'image': episode['filename']
                 }
 
-                if episode['firstaired'] is not None and sonarr_format['timeOfDay']['hours'] is not None:
-                    if episode['language'] in LanguageTimezone.__members__:
-                        episode_timezone = LanguageTimezone[episode['language']].value
-                    else:
-                        episode_timezone = 'EST'
-                    timezone = pytz.timezone(episode_timezone)
-                    date = (dateutil.parser.parse(episode['firstaired']) +
-                            datetime.timedelta(
-                                hours=sonarr_format['timeOfDay']['hours'],
-                                minutes=sonarr_format['timeOfDay']['minutes']
-                            ))
-                    date = timezone.localize(date)
-                    date = date.astimezone(pytz.timezone('UTC'))
-                    sonarr_episode['airDateUtc'] = date.strftime("%Y-%m-%dT%H:%M:%SZ")
+                episode_languages.append(episode['language'])
 
                 if int(episode['seasonnumber']) > 0:
                     sonarr_episode['seasonNumber'] = int(episode['seasonnumber'])
@@ -271,10 +385,11 @@ class TvDB:
                         sonarr_episode['writers'] = [episode['writer']]
 
                 sonarr_episodes.append(sonarr_episode)
+        episode_transformer.set_air_dates_utc(sonarr_episodes, episode_languages, time_of_day)
         sonarr_format['episodes'] = sonarr_episodes
 
         # Seasons
-        banners = self.tvdb[result['id']]['_banners']
+        banners = original_show['_banners']
         if banners and 'season' in banners:
             sonarr_banners = []
             inner_banners = {}
@@ -373,7 +488,7 @@ class TvDB:
         # Seasons end
 
         # Actors
-        actors = self.tvdb[result['id']]['_actors']
+        actors = original_show['_actors']
         if actors:
             sonarr_actors = []
             for actor in actors:
@@ -0,0 +1,115 @@
+import random
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+from skyhook.metrics import upstream_errors, upstream_latency
+
+TVMazeShow = namedtuple('TVMazeShow', ['id', 'name', 'externals'])
+# Upstream responses that are retried
+RETRY_STATUSES = [500, 502, 503, 504]
+
+
+class JitterRetry(Retry):
+    # Full jitter, so workers retrying the same failing upstream don't all come back at the same moment
+    def get_backoff_time(self):
+        return random.uniform(0, super(JitterRetry, self).get_backoff_time())
+
+
+def redirect_url(url, hosts):
+    # hosts maps upstream host names to the base URL of a server standing in for them
+    parts = urlsplit(url)
+    base = hosts.get(parts.hostname)
+    if base is None:
+        return url
+    base = urlsplit(base)
+    return urlunsplit((base.scheme, base.netloc, base.path.rstrip('/') + parts.path, parts.query, parts.fragment))
+
+
+class RedirectMixin(object):
+    hosts = {}
+
+    def request(self, method, url, **kwargs):
+        return super(RedirectMixin, self).request(method, redirect_url(url, self.hosts), **kwargs)
+
+
+class TimeoutMixin(object):
+    timeout = None
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super(TimeoutMixin, self).request(method, url, **kwargs)
+
+
+class MetricsMixin(object):
+    def request(self, method, url, **kwargs):
+        host = urlsplit(url).hostname
+        started = time.time()
+        try:
+            response = super(MetricsMixin, self).request(method, url, **kwargs)
+        except requests.RequestException:
+            upstream_errors.inc(host=host, client='requests')
+            raise
+        upstream_latency.observe(time.time() - started, host=host, client='requests')
+        if response.status_code >= 500:
+            upstream_errors.inc(host=host, client='requests')
+        return response
+
+
+class UpstreamSession(MetricsMixin, RedirectMixin, TimeoutMixin, requests.Session):
+    pass
+
+
+class Upstream(object):
+    # One pooled, keep-alive HTTP transport for the upstream calls made with requests: the TVDB configuration the
+    # tvdb_api clients load, TVDB pages and TV Maze. Series data is downloaded by AsyncUpstream.
+    def __init__(self, config):
+        self.timeout = (config['UPSTREAM_CONNECT_TIMEOUT'], config['UPSTREAM_READ_TIMEOUT'])
+        self.hosts = config['UPSTREAM_HOSTS']
+        self.adapter = HTTPAdapter(
+            pool_connections=config['UPSTREAM_POOL_HOSTS'],
+            pool_maxsize=config['UPSTREAM_POOL_SIZE'],
+            max_retries=JitterRetry(
+                total=config['UPSTREAM_RETRIES'],
+                backoff_factor=config['UPSTREAM_RETRY_BACKOFF'],
+                status_forcelist=RETRY_STATUSES
+            )
+        )
+        self.session = self.mount(UpstreamSession())
+
+    def mount(self, session):
+        session.timeout = self.timeout
+        session.hosts = self.hosts
+        session.mount('http://', self.adapter)
+        session.mount('https://', self.adapter)
+        return session
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def get_tvmaze_show(self, tvdb_id):
+        r = self.get('http://api.tvmaze.com/lookup/shows', params={'thetvdb': tvdb_id})
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        show = r.json()
+        return TVMazeShow(show['id'], show['name'], show['externals'] or {})
+
+    def pool_stats(self):
+        stats = {}
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats[pool.scheme + '://' + pool.host + ':' + str(pool.port)] = {
+                'connections': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle': pool.pool.qsize() if pool.pool is not None else 0,
+                'maxsize': self.adapter._pool_maxsize
+            }
+        return stats
@@ -1,39 +1,168 @@
 import flask
 import json
+import random
+import time
 
-from flask import request, Response
-from skyhook import app, tvdb
+from flask import g, request, Response, stream_with_context
+from skyhook import aio, app, db, tvdb, upstream
+from sqlalchemy import event
+from werkzeug.http import is_resource_modified
 
-from skyhook.cache import SonarrCache, handle_search
+from skyhook.cache import CachedDocument, SonarrCache, handle_search, prewarmer, show_refresher, tag_lookup
+from skyhook.coalesce import advisory_lock
+from skyhook.encoding import gzip_bytes, iter_gzip, strong_etag
 from skyhook.logger import Logger
+from skyhook.metrics import db_queries, db_query_latency, registry, request_latency, requests_in_flight, \
+    stage_latency
 from skyhook.models import Show
+from skyhook.profiler import RequestProfile
+from skyhook.streaming import iter_json_array
 
 logging = Logger(__name__)
+# ?stream= values that ask for a streamed show
+STREAM_VALUES = ('1', 'true', 'yes')
 
-def handle_results(search_string, language):
+
+@app.before_first_request
+def start_prewarming():
+    # Started from the first request so the thread lives in the worker process and not in the uwsgi master
+    if app.config['PREWARM_ENABLED']:
+        prewarmer.start()
+
+
+@app.before_request
+def start_request_metrics():
+    g.started = time.time()
+    g.db_queries = 0
+    g.endpoint = request.endpoint or 'unknown'
+    g.lookups = []
+    requests_in_flight.inc(endpoint=g.endpoint)
+    g.profile = None
+    if should_profile():
+        g.profile = RequestProfile(app.config['PROFILE_INTERVAL'], app.config['PROFILE_ALL_THREADS'])
+        g.profile.start()
+
+
+def should_profile():
+    if not app.config['PROFILE_ENABLED']:
+        return False
+    flag = request.headers.get(app.config['PROFILE_HEADER'], request.args.get(app.config['PROFILE_FLAG']))
+    if flag is not None and app.config['PROFILE_TOKEN'] is not None:
+        return flag == app.config['PROFILE_TOKEN']
+    return random.random() < app.config['PROFILE_SAMPLE_RATE']
+
+
+@app.after_request
+def record_status(response):
+    g.status = response.status_code
+    return response
+
+
+@app.teardown_request
+def record_request_metrics(exception=None):
+    # The request context is torn down once a streamed body has been sent, so streaming is included. Streamed
+    # responses can be torn down twice, only the first one is recorded.
+    started = g.get('started')
+    if started is None:
+        return
+    g.started = None
+    requests_in_flight.dec(endpoint=g.endpoint)
+    request_latency.observe(time.time() - started, endpoint=g.endpoint,
+                            status=500 if exception is not None else g.get('status', 500))
+    db_queries.observe(g.db_queries, endpoint=g.endpoint)
+
+
+@app.teardown_request
+def write_profile(exception=None):
+    profile = g.get('profile')
+    if profile is None:
+        return
+    g.profile = None
+    profile.stop()
+    profile.tags.update({
+        'route': request.url_rule.rule if request.url_rule is not None else request.path,
+        'url': request.full_path,
+        'tvdb_id': (request.view_args or {}).get('tvdb_id'),
+        'cache': ','.join(sorted(set(g.lookups))) or 'none',
+        'status': 500 if exception is not None else g.get('status', 500)
+    })
+    try:
+        path = profile.write(app.config['PROFILE_DIR'])
+        logging.info('Wrote profile of ' + request.full_path + ' to ' + path + '.collapsed')
+    except OSError as e:
+        logging.warning('Unable to write profile of ' + request.full_path + ': ' + str(e))
+
+
+@event.listens_for(db.engine, 'before_cursor_execute')
+def start_query_metrics(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_started', []).append(time.time())
+    if flask.has_request_context() and g.get('db_queries') is not None:
+        g.db_queries += 1
+
+
+@event.listens_for(db.engine, 'after_cursor_execute')
+def record_query_metrics(connection, cursor, statement, parameters, context, executemany):
+    duration = time.time() - connection.info['query_started'].pop()
+    db_query_latency.observe(duration)
+    if flask.has_request_context() and g.get('profile') is not None:
+        g.profile.record_query(statement, parameters, duration)
+
+
+def cached_show_summary(tvdb_id, language):
+    # Built from the show and season rows, decoding a stored document would read every episode only to drop them
+    return SonarrCache.get_cached_show(tvdb_id, language).to_sonarr_summary()
+
+
+def cached_results(search_string, language):
+    if not SonarrCache.has_cached_results(search_string, language):
+        return None
+    logging.info('Found cached results for search string "' + search_string + '"')
     sonarr_results = []
-    if SonarrCache.has_cached_results(search_string, language):
-        logging.info('Found cached results for search string "' + search_string + '"')
-        cached_result = SonarrCache.get_cached_results(search_string, language)
-        for tvdb_ids in cached_result.results:
-            if language is None:
-                cached_show = SonarrCache.get_cached_show(tvdb_ids, cached_result.language).to_sonarr_format()
-                cached_show.pop('episodes', None)
-                sonarr_results.append(cached_show)
-            else:
-                cached_show = SonarrCache.get_cached_show(tvdb_ids, language).to_sonarr_format()
-                cached_show.pop('episodes', None)
-                sonarr_results.append(cached_show)
-    else:
+    cached_result = SonarrCache.get_cached_results(search_string, language)
+    for tvdb_ids in cached_result.results:
+        if language is None:
+            sonarr_results.append(cached_show_summary(tvdb_ids, cached_result.language))
+        else:
+            sonarr_results.append(cached_show_summary(tvdb_ids, language))
+    return sonarr_results
+
+
+def indexed_results(search_string, language, min_score):
+    if not app.config['SEARCH_INDEX_ENABLED']:
+        return None
+    matches = SonarrCache.search_index_matches(search_string, language, min_score)
+    if not matches:
+        return None
+    logging.info('Found ' + str(len(matches)) + ' indexed shows for search string "' + search_string + '"')
+    tag_lookup('search_index', 'hit')
+    return [cached_show_summary(tvdb_id, show_language) for tvdb_id, show_language in matches]
+
+
+def search_upstream(search_string, language):
+    with advisory_lock('search:' + str(language) + ':' + search_string):
+        # Another process may have run the same search while we were waiting for the lock
+        sonarr_results = cached_results(search_string, language)
+        if sonarr_results is not None:
+            return sonarr_results
+        tag_lookup('search', 'upstream')
         results = tvdb.search(search_string, language)
         sonarr_results = handle_search(search_string, results, with_episodes=False)
-    # FIXME: dirty workaround to make sure we send the proper results
-    if isinstance(sonarr_results, Show):
-        sonarr_results = [sonarr_results.to_sonarr_format()]
-    else:
-        for i in range(0, len(sonarr_results)):
-            if isinstance(sonarr_results[i], Show):
-                sonarr_results[i] = sonarr_results[i].to_sonarr_format()
+        # Plain dicts, the results are handed to every request waiting on this search
+        return [show.to_sonarr_summary() if isinstance(show, Show) else show for show in sonarr_results]
+
+
+def handle_results(search_string, language):
+    # One form of the term for the cache, the in-process flights and the cross-process lock
+    search_string = ' '.join(search_string.lower().split())
+    sonarr_results = cached_results(search_string, language)
+    if sonarr_results is None:
+        sonarr_results = indexed_results(search_string, language, app.config['SEARCH_INDEX_MIN_SCORE'])
+    if sonarr_results is None:
+        sonarr_results = SonarrCache.search_flights.do((search_string, language), search_upstream, search_string,
+                                                       language)
+    if not sonarr_results:
+        # TVDB only returns exact titles, offer close matches from the shows we know of instead of nothing
+        sonarr_results = indexed_results(search_string, language, app.config['SEARCH_INDEX_FUZZY_SCORE']) or []
     return sonarr_results
 
 
@@ -60,16 +189,200 @@ def search(language):
 
     sonarr_results = handle_results(search_string, language)
 
-    return Response(json.dumps(sonarr_results), mimetype='application/json')
+    with stage_latency.time(stage='encode'):
+        body = ''.join(iter_json_array(sonarr_results)).encode('utf-8')
+    return validated_response(body, strong_etag(body))
 
 
 @app.route('/v1/tvdb/shows/<language>/<tvdb_id>')
 def shows(language, tvdb_id):
     # TODO: Language
     language = None
-    cached_show = SonarrCache.get_cached_show(tvdb_id, language, True)
-    if isinstance(cached_show, Show):
-        cached_show = cached_show.to_sonarr_format()
-    return Response(json.dumps(cached_show), mimetype='application/json')
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = int(since)
+        except ValueError:
+            flask.abort(400)
+    if request.args.get('stream', '').lower() not in STREAM_VALUES and since is None:
+        show = SonarrCache.get_cached_document(tvdb_id, language)
+        if isinstance(show, CachedDocument):
+            return validated_response(show.document, show.etag, show.changed, show.get_gzipped)
+    else:
+        show = SonarrCache.get_cached_show(tvdb_id, language, update_show=True)
+
+    # Large shows (and ?stream=1) are encoded from the database while the response is being sent
+    if since is not None and show.delta_since <= since <= show.revision:
+        # Only what changed after the revision the client has, the response says which revision it is at now
+        return streamed_response(show.iter_sonarr_delta_json(since, app.config['STREAM_EPISODE_BATCH']))
+    # A revision this show never had (the cache was rebuilt) or one too old to have its deletions gets the whole show
+    return streamed_response(show.iter_sonarr_json(app.config['STREAM_EPISODE_BATCH']),
+                             SonarrCache.get_show_etag(show))
+
+
+def streamed_response(chunks, etag=None):
+    gzipped = accepts_gzip()
+    if etag is not None and gzipped:
+        etag += '-gzip'
+    response = not_modified(etag)
+    if response is not None:
+        return response
+    if gzipped:
+        chunks = iter_gzip(chunks, app.config['GZIP_LEVEL'])
+    response = Response(stream_with_context(chunks), mimetype='application/json')
+    if gzipped:
+        response.content_encoding = 'gzip'
+    return set_validators(response, etag)
+
+
+@app.route('/v1/tvdb/shows/<language>/batch', methods=['GET', 'POST'])
+def batch_shows(language):
+    # TODO: Language
+    language = None
+    tvdb_ids = batch_tvdb_ids()
+    results = SonarrCache.get_cached_batch(tvdb_ids, language)
+    logging.debug('Batch of ' + str(len(tvdb_ids)) + ' shows: ' +
+                  ', '.join(status + '=' + str(sum(1 for result in results if result[1] == status))
+                            for status in ('cached', 'stale', 'fetched', 'not_found', 'error')))
+    return streamed_response(iter_batch_json(results))
+
+
+def batch_tvdb_ids():
+    # ?ids=1,2,3 or a POSTed JSON list of ids (or {"ids": [...]}), duplicates are dropped
+    ids = request.get_json(silent=True) if request.method == 'POST' else None
+    if isinstance(ids, dict):
+        ids = ids.get('ids')
+    if ids is None:
+        ids = [tvdb_id for tvdb_id in request.args.get('ids', '').split(',') if tvdb_id.strip()]
+    if not isinstance(ids, list):
+        flask.abort(400)
+    tvdb_ids = []
+    for tvdb_id in ids:
+        try:
+            tvdb_id = int(str(tvdb_id).strip())
+        except ValueError:
+            flask.abort(400)
+        if tvdb_id not in tvdb_ids:
+            tvdb_ids.append(tvdb_id)
+    if len(tvdb_ids) > app.config['BATCH_MAX_SHOWS']:
+        flask.abort(400)
+    return tvdb_ids
+
+
+def iter_batch_json(results):
+    # [{"tvdbId": ..., "status": ..., "show": ...}, ...], stored documents are sent as they are
+    yield '['
+    separator = ''
+    for tvdb_id, status, show in results:
+        yield separator + '{"tvdbId": ' + str(tvdb_id) + ', "status": "' + status + '"'
+        if isinstance(show, CachedDocument):
+            yield ', "show": '
+            yield show.document
+        elif show is not None:
+            yield ', "show": '
+            for chunk in show.iter_sonarr_json(app.config['STREAM_EPISODE_BATCH']):
+                yield chunk
+        yield '}'
+        separator = ', '
+    yield ']'
+
+
+def accepts_gzip(size=None):
+    if not app.config['GZIP_ENABLED'] or 'gzip' not in request.accept_encodings:
+        return False
+    return size is None or size >= app.config['GZIP_MIN_BYTES']
+
+
+def set_validators(response, etag, last_modified=None):
+    if etag is not None:
+        response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    # A 304 response when the client's copy is still current, None when the body has to be sent
+    if etag is None and last_modified is None:
+        return None
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return set_validators(Response(status=304), etag, last_modified)
+
+
+def validated_response(body, etag, last_modified=None, get_gzipped=None):
+    # body is the JSON response, get_gzipped(level) returns it compressed when that is kept somewhere. The gzipped
+    # response is a different representation and gets its own ETag.
+    gzipped = accepts_gzip(len(body))
+    if gzipped:
+        etag += '-gzip'
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+    if gzipped:
+        compressed = get_gzipped(app.config['GZIP_LEVEL']) if get_gzipped is not None else \
+            gzip_bytes(body, app.config['GZIP_LEVEL'])
+        response = Response(compressed, mimetype='application/json')
+        response.content_encoding = 'gzip'
+    else:
+        response = Response(body, mimetype='application/json')
+    return set_validators(response, etag, last_modified)
+
+
+def pool_stats():
+    # {client: {pool: stats}}, TVDB series data and TV Maze go through aiohttp, everything else through requests
+    return {'requests': upstream.pool_stats(), 'aiohttp': aio.pool_stats()}
+
+
+@app.route('/v1/status/upstream')
+def upstream_status():
+    return Response(json.dumps(pool_stats()), mimetype='application/json')
+
+
+@app.route('/v1/status/writes')
+def write_status():
+    return Response(json.dumps(SonarrCache.row_changes.stats()), mimetype='application/json')
+
+
+@app.route('/metrics')
+def metrics():
+    # Prometheus text format. Every uwsgi worker keeps its own numbers, so they describe the worker that answers.
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+def memory_cache_stats(stat):
+    return lambda: {('search',): SonarrCache.search_memory.stats()[stat],
+                    ('show',): SonarrCache.show_memory.stats()[stat]}
+
+
+def upstream_pool_stats(stat):
+    return lambda: dict(((client, pool), stats[stat]) for client, pools in pool_stats().items()
+                        for pool, stats in pools.items())
 
 
+registry.gauge('skyhook_memory_cache_entries', 'Entries in the in-process caches.', ['cache'],
+               memory_cache_stats('entries'))
+registry.gauge('skyhook_memory_cache_weight', 'Weight of the in-process caches (searches, show bytes).', ['cache'],
+               memory_cache_stats('weight'))
+registry.counter('skyhook_memory_cache_hits_total', 'In-process cache hits.', ['cache'], memory_cache_stats('hits'))
+registry.counter('skyhook_memory_cache_misses_total', 'In-process cache misses.', ['cache'],
+                 memory_cache_stats('misses'))
+registry.counter('skyhook_memory_cache_evictions_total', 'In-process cache evictions.', ['cache'],
+                 memory_cache_stats('evictions'))
+registry.gauge('skyhook_upstream_fetches_in_flight', 'Coalesced upstream searches and show fetches running.', ['kind'],
+               lambda: {('search',): SonarrCache.search_flights.in_flight(),
+                        ('show',): SonarrCache.show_flights.in_flight()})
+registry.gauge('skyhook_refreshes_pending', 'Background show refreshes queued or running.',
+               function=lambda: {(): len(show_refresher.pending)})
+registry.gauge('skyhook_upstream_pool_connections',
+               'Connections opened by each upstream pool (requests), open in each pool (aiohttp).', ['client', 'pool'],
+               upstream_pool_stats('connections'))
+registry.gauge('skyhook_upstream_pool_idle', 'Idle connections in each upstream pool.', ['client', 'pool'],
+               upstream_pool_stats('idle'))
+registry.counter('skyhook_rows_written_total', 'Rows compared by update_show, by table and outcome.',
+                 ['table', 'outcome'],
+                 lambda: dict(((table, outcome), count) for table, counts in SonarrCache.row_changes.stats().items()
+                              for outcome, count in counts.items()))
+registry.gauge('skyhook_search_index_entries', 'Shows in the title search index.',
+               function=lambda: {(): len(SonarrCache.search_index)})